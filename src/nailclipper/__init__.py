@@ -1,3 +1,8 @@
 from nailclipper.thumbnail_generator import ThumbnailGenerator
 from nailclipper.thumbnail_manager import ThumbnailManager
-from nailclipper.enums import Size, RefreshPolicy, CacheDir, CustomSizePolicy, ResizeStyle, Resample, Compliance
\ No newline at end of file
+from nailclipper.async_thumbnail_manager import AsyncThumbnailManager
+from nailclipper.thumbnail_scheduler import ThumbnailScheduler
+from nailclipper.thumbnail_index import ThumbnailIndex
+from nailclipper.thumbnail_store import SQLiteStore, MemoryStore
+from nailclipper.encoders import PngEncoder, WebpEncoder, JpegEncoder
+from nailclipper.enums import Size, RefreshPolicy, RetryPolicy, StalePolicy, CacheDir, CacheLayout, CustomSizePolicy, ResizeStyle, Resample, Compliance, ThumbnailStatus
\ No newline at end of file
@@ -0,0 +1,41 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from nailclipper.thumbnail_manager import _normalize_uri
+
+class AsyncThumbnailManager:
+    """ Awaitable front-end for a ThumbnailManager. Blocking work is run on thread pools so it never blocks the event loop. """
+
+    def __init__(self, thumbnail_manager, workers=None):
+
+        self.thumbnail_manager = thumbnail_manager
+
+        # Cache lookups get their own pool so cache hits don't queue behind slow renders.
+        self._lookup_executor = ThreadPoolExecutor()
+        self._render_executor = ThreadPoolExecutor(workers)
+        self._pending = {}
+
+    def __del__(self):
+        self._lookup_executor.shutdown(wait=False)
+        self._render_executor.shutdown(wait=False)
+
+    async def get_thumbnail(self, uri, style=None):
+        """ Awaitable version of ThumbnailManager.get_thumbnail. Concurrent calls for the same thumbnail share a single render. """
+
+        loop = asyncio.get_running_loop()
+        uri = _normalize_uri(uri)
+
+        thumbnail = await loop.run_in_executor(self._lookup_executor, self.thumbnail_manager._cached_thumbnail, uri, style)
+        if thumbnail:
+            return thumbnail
+
+        key = (loop, self.thumbnail_manager._thumbnail_path(uri, style))
+        future = self._pending.get(key)
+
+        if future is None:
+            future = loop.run_in_executor(self._render_executor, self.thumbnail_manager.get_thumbnail, uri, style)
+            self._pending[key] = future
+            future.add_done_callback(lambda f: self._pending.pop(key, None))
+
+        # Shielded so one caller being cancelled doesn't cancel the render for everyone else waiting on it.
+        return await asyncio.shield(future)
@@ -0,0 +1,51 @@
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no advisory file locks, there cache files are still written atomically but not locked
+    fcntl = None
+
+def write_atomic(path, data):
+    """ Writes the data to path through a temporary file in the same folder that is renamed into place,
+        so other processes never see a partly written file. """
+    temp_path = path.with_name(f'.{path.name}.{os.getpid()}-{os.urandom(4).hex()}.tmp')
+    # Opened like open() would (permissions from the umask), failing rather than sharing a leftover temporary file
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+@contextmanager
+def file_lock(path):
+    """ Holds an exclusive advisory lock for path (on a lock file next to it) while the block runs,
+        waiting for other processes and threads that hold it. Does nothing where file locks aren't available. """
+    if fcntl is None:
+        yield
+        return
+    lock_path = path.with_name(path.name + '.lock')
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # The previous holder removes the lock file, if that happened while waiting lock the new one instead
+            if os.path.samestat(os.fstat(fd), os.stat(lock_path)):
+                break
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+    try:
+        yield
+    finally:
+        # Removed while still locked, so whoever is waiting for it sees that and locks a new one
+        lock_path.unlink(missing_ok=True)
+        os.close(fd)
@@ -0,0 +1,105 @@
+import json
+from io import BytesIO
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+from nailclipper.png_text import read_png_text, PNG_SIGNATURE
+
+# EXIF ImageDescription, which holds the metadata of JPEG and WebP thumbnails as JSON (they have no text chunks like PNG)
+EXIF_IMAGE_DESCRIPTION = 0x010E
+
+# Suffixes of the files the encoders write, so cache scans can find thumbnails of any format
+suffixes = ('.png', '.jpg', '.webp')
+
+class PngEncoder:
+    """ Encodes thumbnails as PNG, with the metadata in text chunks. This is the only format the Freedesktop thumbnail spec allows.
+
+        compress_level is the zlib level from 0 (fastest, largest) to 9 (slowest, smallest), None uses the Pillow default (6).
+        strategy is a zlib strategy (zlib.Z_FILTERED, Z_HUFFMAN_ONLY, Z_RLE or Z_FIXED), Z_RLE is much faster and suits flat, icon-like thumbnails.
+        optimize makes Pillow search for the smallest output, which is slow. colors quantizes the thumbnail to a palette of at most that many
+        colors (with alpha), which makes icon-like thumbnails a lot smaller. """
+
+    format = 'PNG'
+    suffix = '.png'
+
+    def __init__(self, compress_level=None, strategy=None, optimize=False, colors=None):
+        self.compress_level = compress_level
+        self.strategy = strategy
+        self.optimize = optimize
+        self.colors = colors
+
+    def encode(self, image, metadata=None):
+        if self.colors:
+            # Fast octree is the only built in method that keeps the alpha channel
+            image = image.quantize(self.colors, method=Image.Quantize.FASTOCTREE)
+        options = {'optimize': self.optimize}
+        if self.compress_level is not None:
+            options['compress_level'] = self.compress_level
+        if self.strategy is not None:
+            options['compress_type'] = self.strategy
+        if metadata is not None:
+            options['pnginfo'] = _png_info(metadata)
+        data = BytesIO()
+        image.save(data, 'png', **options)
+        return data.getvalue()
+
+class WebpEncoder:
+    """ Encodes thumbnails as WebP, lossless or lossy at the quality (0 to 100). method trades encoding speed (0) for size (6). """
+
+    format = 'WEBP'
+    suffix = '.webp'
+
+    def __init__(self, lossless=False, quality=80, method=4):
+        self.lossless = lossless
+        self.quality = quality
+        self.method = method
+
+    def encode(self, image, metadata=None):
+        data = BytesIO()
+        image.save(data, 'webp', lossless=self.lossless, quality=self.quality, method=self.method, exif=_exif(metadata))
+        return data.getvalue()
+
+class JpegEncoder:
+    """ Encodes thumbnails as JPEG at the quality (0 to 100). JPEG has no transparency, so thumbnails are put on the background color. """
+
+    format = 'JPEG'
+    suffix = '.jpg'
+
+    def __init__(self, quality=85, optimize=False, background=(255, 255, 255)):
+        self.quality = quality
+        self.optimize = optimize
+        self.background = background
+
+    def encode(self, image, metadata=None):
+        if image.mode in ['RGBA', 'LA', 'P']:
+            image = image.convert('RGBA')
+            image = Image.alpha_composite(Image.new('RGBA', image.size, self.background), image)
+        data = BytesIO()
+        image.convert('RGB').save(data, 'jpeg', quality=self.quality, optimize=self.optimize, exif=_exif(metadata))
+        return data.getvalue()
+
+def read_metadata(path):
+    """ Reads the metadata of a thumbnail in any of the encoder formats without decoding the image. """
+    with open(path, 'rb') as f:
+        is_png = f.read(8) == PNG_SIGNATURE
+    if is_png:
+        return read_png_text(path)
+    with Image.open(path) as image:
+        description = image.getexif().get(EXIF_IMAGE_DESCRIPTION)
+    if description is None:
+        return {}
+    try:
+        return json.loads(description)
+    except ValueError:
+        return {}
+
+def _png_info(metadata):
+    png_info = PngInfo()
+    for key, value in metadata.items():
+        png_info.add_text(key, value)
+    return png_info
+
+def _exif(metadata):
+    exif = Image.Exif()
+    if metadata is not None:
+        exif[EXIF_IMAGE_DESCRIPTION] = json.dumps(metadata)
+    return exif.tobytes()
@@ -1,5 +1,6 @@
 import os
 import time
+import functools
 from pathlib import Path
 from urllib.parse import urlparse, unquote
 import platform
@@ -7,14 +8,24 @@ import re
 
 from PIL import Image
 
+from nailclipper.encoders import read_metadata
+
+def _interval_check(days, thumbnail_path, file_uri):
+    thumb_mtime = os.stat(thumbnail_path).st_mtime
+    return (time.time() - thumb_mtime) >= (days*24*60*60)
+
+def interval_days(refresh_policy):
+    """ Returns the number of days of a RefreshPolicy.INTERVAL policy, or None for any other policy. """
+    if isinstance(refresh_policy, functools.partial) and refresh_policy.func is _interval_check:
+        return refresh_policy.args[0]
+    return None
+
 class Interval:
 
     def __call__(self, days=10):
-        # This method returns a method, so you can specify the update interval
-        def interval_check(thumbnail_path, file_uri):
-            thumb_mtime = os.stat(thumbnail_path).st_mtime
-            return (time.time() - thumb_mtime) >= (days*24*60*60)
-        return interval_check
+        # This method returns a method, so you can specify the update interval.
+        # A partial (rather than a closure) keeps the policy picklable for process pools.
+        return functools.partial(_interval_check, days)
 
     def __get__(self, obj, objType=None):
         return self()
@@ -28,6 +39,14 @@ class Size:
 
 freedesktop_sizes = [Size.NORMAL, Size.LARGE, Size.XLARGE, Size.XXLARGE]
 
+def is_stale_metadata(metadata, file_uri, file_stat=None):
+    """ Checks the Thumb::MTime and Thumb::Size metadata of a thumbnail against the file, as in the Freedesktop thumbnail spec. """
+    if file_stat is None:
+        file_stat = os.stat(unquote(urlparse(file_uri).path))
+    return ((not 'Thumb::MTime' in metadata) # When implementing shared cache, add 'and not thumbnail_manager.is_shared' check somehow
+        or (str(file_stat.st_mtime) != metadata['Thumb::MTime'])
+        or ('Thumb::Size' in metadata and str(file_stat.st_size) != metadata['Thumb::Size']))
+
 class RefreshPolicy:
     """ Methods for determining if a thumbnail needs to be updated """
 
@@ -38,13 +57,7 @@ class RefreshPolicy:
         """ Thumbnail update algorithm from the Freedesktop thumbnail spec """
         if urlparse(file_uri).scheme != 'file':
             return False
-        image = Image.open(thumbnail_path)
-        file_path = unquote(urlparse(file_uri).path)
-        file_mtime = str(os.stat(file_path).st_mtime)
-        file_size = str(os.path.getsize(file_path))
-        return ((not 'Thumb::MTime' in image.text) # When implementing shared cache, add 'and not thumbnail_manager.is_shared' check somehow
-            or ('Thumb::MTime' in image.text and file_mtime != image.text['Thumb::MTime'])
-            or ('Thumb::Size' in image.text and file_size != image.text['Thumb::Size']))
+        return is_stale_metadata(read_metadata(thumbnail_path), file_uri)
 
     @staticmethod
     def AUTO(thumbnail_path, file_uri):
@@ -59,6 +72,37 @@ class RefreshPolicy:
         """ Never update the thumbnail once created. """
         return False
 
+class RetryPolicy:
+    """ Methods for determining if a file should be rendered again after it failed, called with the number of failed attempts and the time of the last one.
+        A fail thumbnail is always dropped when the file's modified time or size changes. """
+
+    @staticmethod
+    def BACKOFF(attempts=None, failed_time=None, *, base=60, factor=2, max_delay=24*60*60, max_attempts=None):
+        """ Retry after base seconds, then wait factor times longer after each failed attempt (up to max_delay), giving up after max_attempts if given.
+            Calling it with only options, as in RetryPolicy.BACKOFF(base=10), returns a policy with those options. """
+        if attempts is None:
+            return functools.partial(RetryPolicy.BACKOFF, base=base, factor=factor, max_delay=max_delay, max_attempts=max_attempts)
+        if max_attempts is not None and attempts >= max_attempts:
+            return False
+        delay = min(base * factor**(attempts - 1), max_delay)
+        return (time.time() - failed_time) >= delay
+
+    @staticmethod
+    def NEVER(attempts, failed_time):
+        """ Only retry once the file is changed, as in the Freedesktop thumbnail spec. """
+        return False
+
+    @staticmethod
+    def ALWAYS(attempts, failed_time):
+        """ Retry on every request. """
+        return True
+
+class StalePolicy:
+    """ Options for what get_thumbnail returns when the cached thumbnail is stale (see RefreshPolicy). """
+    REFRESH    = object() # Wait for the thumbnail to be created again
+    FALLBACK   = object() # Wait for the thumbnail to be created again, but return the stale thumbnail if that fails
+    REVALIDATE = object() # Return the stale thumbnail right away and create it again in the background
+
 def get_xdg_home():
     """ Gets the XDG cache directory. For windows this returns the same cache location that the Windows version of KDE Dolphin uses (AppData/.cache). """
     if platform.system() == 'Windows':
@@ -74,6 +118,26 @@ class CacheDir:
     TEMP        = object()
     AUTO        = object()
 
+class ThumbnailStatus:
+    """ Status of a file's cached thumbnail, see ThumbnailManager.check_directory. """
+    FRESH   = 'fresh'
+    STALE   = 'stale'
+    FAILED  = 'failed'
+    MISSING = 'missing'
+
+class CacheLayout:
+    """ How thumbnail files are laid out within a cache folder. """
+
+    @staticmethod
+    def FLAT(name):
+        """ All thumbnails directly in the cache folder, as in the Freedesktop thumbnail spec. """
+        return Path(name)
+
+    @staticmethod
+    def SHARDED(name):
+        """ Thumbnails in two levels of sub folders named after the start of the hash (ab/cd/abcd...png), this keeps folders small in very large caches. """
+        return Path(name[0:2]) / name[2:4] / name
+
 class CustomSizePolicy:
     # TODO: Implement this
     RESIZE = object()
@@ -102,12 +166,17 @@ class Compliance:
             and tm.cache_folders[Size.XLARGE] == 'x-large'
             and tm.cache_folders[Size.XXLARGE] == 'xx-large'
             and tm.cache_dir == CacheDir.FREEDESKTOP
+            and tm.cache_layout == CacheLayout.FLAT
+            and tm.store is None
             and re.match(r'fail\/.+-.+', tm.fail_folder)
             and tm.refresh_policy in [RefreshPolicy.FREEDESKTOP, RefreshPolicy.AUTO]
             and all((
                 tg.resize_style in [ResizeStyle.FIT, ResizeStyle.PADDING]
                 and tg.mask == None
                 and tg.foreground == None
+                # The spec requires 8 bit RGBA PNGs
+                and tg.encoder.format == 'PNG'
+                and not getattr(tg.encoder, 'colors', None)
                 for tg in tm.thumbnail_generators.values()
             ))
         )
@@ -120,8 +189,12 @@ class Compliance:
             and tm.cache_folders[Size.XLARGE] == 'x-large'
             and tm.cache_folders[Size.XXLARGE] == 'xx-large'
             and tm.cache_dir == CacheDir.FREEDESKTOP
+            and tm.cache_layout == CacheLayout.FLAT
+            and tm.store is None
             and re.match(r'fail\/.+-.+', tm.fail_folder)
             and tm.refresh_policy in [RefreshPolicy.FREEDESKTOP, RefreshPolicy.AUTO]
+            # The spec only tries files that failed again once they are modified
+            and tm.retry_policy == RetryPolicy.NEVER
             and all((
                 tg.background == (0, 0, 0, 0)
                 and tg.resize_style == ResizeStyle.FIT
@@ -129,6 +202,8 @@ class Compliance:
                 and tg.foreground == None
                 and tg.resample == Resample.AUTO
                 and tg.upscale == True
+                and tg.encoder.format == 'PNG'
+                and not getattr(tg.encoder, 'colors', None)
                 for tg in tm.thumbnail_generators.values()
             ))
 
@@ -0,0 +1,69 @@
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def read_png_text(path):
+    """ Reads the text chunks (tEXt, zTXt and iTXt) of a PNG file without decoding the image.
+        Only chunks before the image data are read, which is where thumbnail metadata is written. """
+
+    text = {}
+
+    with open(path, 'rb') as f:
+
+        if f.read(8) != PNG_SIGNATURE:
+            raise ValueError(f'{path} is not a PNG file')
+
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+
+            length, chunk_type = struct.unpack('>I4s', header)
+
+            if chunk_type in [b'IDAT', b'IEND']:
+                break
+            elif chunk_type in [b'tEXt', b'zTXt', b'iTXt']:
+                key, value = _parse_text_chunk(chunk_type, f.read(length))
+                text[key] = value
+                f.seek(4, 1) # CRC
+            else:
+                f.seek(length + 4, 1)
+
+    return text
+
+def add_png_text(data, text):
+    """ Returns the PNG data with text chunks for the text (a dict of keyword to value) inserted after the header,
+        which is where Pillow writes them too. This lets one encoded image be reused with different metadata. """
+
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError('Data is not a PNG image')
+
+    # The IHDR chunk is always first and always 13 bytes long
+    header_end = 8 + 8 + 13 + 4
+    chunks = []
+    for key, value in text.items():
+        try:
+            chunk = b'tEXt' + key.encode('latin-1') + b'\x00' + value.encode('latin-1')
+        except UnicodeEncodeError:
+            # Uncompressed iTXt with no language tag, as Pillow writes text that isn't latin-1
+            chunk = b'iTXt' + key.encode('latin-1') + b'\x00\x00\x00\x00\x00' + value.encode('utf-8')
+        chunks.append(struct.pack('>I', len(chunk) - 4) + chunk + struct.pack('>I', zlib.crc32(chunk)))
+
+    return b''.join([data[:header_end], *chunks, data[header_end:]])
+
+def _parse_text_chunk(chunk_type, data):
+    key, data = data.split(b'\x00', 1)
+    key = key.decode('latin-1')
+
+    if chunk_type == b'tEXt':
+        return key, data.decode('latin-1')
+    elif chunk_type == b'zTXt':
+        return key, zlib.decompress(data[1:]).decode('latin-1')
+    else:
+        compressed = data[0]
+        # Skip the compression method, language tag and translated keyword
+        _, _, data = data[2:].split(b'\x00', 2)
+        if compressed:
+            data = zlib.decompress(data)
+        return key, data.decode('utf-8')
@@ -1,4 +1,6 @@
+from nailclipper.renderers.exif import ExifRenderer
 from nailclipper.renderers.pdf2image import Pdf2ImageRenderer
 from nailclipper.renderers.pillow import PillowRenderer
 from nailclipper.renderers.cairo import CairoRenderer
 from nailclipper.renderers.iconset import IconSet
+from nailclipper.renderers.isolated import IsolatedRenderer
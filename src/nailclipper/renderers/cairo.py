@@ -1,10 +1,23 @@
+import os
+import sys
+from io import BytesIO
+import threading
+from types import SimpleNamespace
+from collections import OrderedDict
 from warnings import warn
 from pathlib  import Path
+from PIL import Image
+from nailclipper.renderers.utils import uri_to_path
 
 class CairoRenderer:
 
     cairo = None
 
+    # Parsed SVG trees of the files rendered most recently, so the same file at other sizes isn't parsed again. Set to 0 to disable.
+    cache_size = 8
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
     @staticmethod
     def init():
         try:
@@ -18,10 +31,68 @@ class CairoRenderer:
         return CairoRenderer.cairo and Path(uri).suffix == '.svg'
 
     @staticmethod
-    def from_file(file, size, save_path):
+    def supported_extensions():
+        return ['.svg'] if CairoRenderer.cairo else []
+
+    @staticmethod
+    def render(uri, size):
+        file = uri_to_path(uri)
+        if file is None:
+            return None
         try:
-            CairoRenderer.cairo.svg2png(url=str(file), write_to=str(save_path))
-            return True
+            tree, lock = CairoRenderer._tree(file)
+            # Drawing sets some state on the tree, so one tree is only drawn by one thread at a time
+            with lock:
+                width, height = CairoRenderer.output_size(CairoRenderer._intrinsic_size(tree), size)
+                surface = CairoRenderer.cairo.surface.PNGSurface(tree, None, 96, output_width=width, output_height=height)
+            return CairoRenderer._surface_image(surface.cairo)
         except Exception as e:
             warn(f'Could not generate thumbnail for {file} using CairoRenderer: {e}')
-            return False
+            return None
+
+    @staticmethod
+    def output_size(intrinsic_size, size):
+        """ The smallest size with the aspect ratio of the SVG that covers the size, or None for an SVG without a size (rendered at its default size). """
+        if intrinsic_size is None:
+            return None, None
+        scale = max(size[0] / intrinsic_size[0], size[1] / intrinsic_size[1])
+        return max(1, round(intrinsic_size[0] * scale)), max(1, round(intrinsic_size[1] * scale))
+
+    @staticmethod
+    def _intrinsic_size(tree):
+        # What cairosvg sizes a surface from, the width and height of the root (falling back to the viewBox) at 96 DPI with no parent
+        surface = SimpleNamespace(dpi=96, font_size=16, context_width=None, context_height=None)
+        width, height, _ = CairoRenderer.cairo.helpers.node_format(surface, tree)
+        if not width or not height:
+            return None
+        return width, height
+
+    @staticmethod
+    def _surface_image(surface):
+        """ Copies a cairo ARGB32 image surface to a Pillow image, without encoding it to PNG. """
+        surface.flush()
+        if sys.byteorder != 'little':
+            # Pillow has no raw mode for big-endian premultiplied ARGB
+            data = BytesIO()
+            surface.write_to_png(data)
+            return Image.open(data)
+        # Cairo stores premultiplied native-endian ARGB words, which is BGRA byte order on little-endian machines
+        size = (surface.get_width(), surface.get_height())
+        return Image.frombuffer('RGBA', size, bytes(surface.get_data()), 'raw', 'BGRa', surface.get_stride(), 1)
+
+    @staticmethod
+    def _tree(file):
+        """ Returns the parsed SVG tree of the file (from the cache if it hasn't changed) and the lock for drawing it. """
+        file_stat = os.stat(file)
+        key = (str(file), file_stat.st_mtime_ns, file_stat.st_size)
+        with CairoRenderer._cache_lock:
+            cached = CairoRenderer._cache.get(key)
+            if cached is not None:
+                CairoRenderer._cache.move_to_end(key)
+                return cached
+        cached = (CairoRenderer.cairo.parser.Tree(url=str(file)), threading.Lock())
+        with CairoRenderer._cache_lock:
+            CairoRenderer._cache[key] = cached
+            while len(CairoRenderer._cache) > CairoRenderer.cache_size:
+                CairoRenderer._cache.popitem(last=False)
+        return cached
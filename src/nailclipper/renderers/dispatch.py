@@ -0,0 +1,73 @@
+import os
+import re
+from nailclipper.renderers.utils import uri_to_path
+
+# Signatures of the formats the bundled renderers handle, as (offset, bytes) and the extension files of that format usually have
+magic_numbers = [
+    ((0, b'\x89PNG\r\n\x1a\n'), '.png'),
+    ((0, b'\xff\xd8\xff'), '.jpg'),
+    ((0, b'GIF87a'), '.gif'),
+    ((0, b'GIF89a'), '.gif'),
+    ((0, b'II*\x00'), '.tif'),
+    ((0, b'MM\x00*'), '.tif'),
+    ((0, b'BM'), '.bmp'),
+    ((8, b'WEBP'), '.webp'),
+    ((0, b'%PDF-'), '.pdf')
+]
+
+# SVG files are XML, so they are recognized by their root element instead
+svg_pattern = re.compile(rb'^\s*(<\?xml[^>]*>\s*)?(<!--.*?-->\s*|<!DOCTYPE[^>]*>\s*)*<svg[\s>]', re.DOTALL)
+
+sniff_length = 512
+
+def sniff_extension(file):
+    """ Guesses the extension of a file from its first bytes, or None if the format isn't recognized. """
+    try:
+        with open(file, 'rb') as f:
+            head = f.read(sniff_length)
+    except OSError:
+        return None
+    for (offset, magic), extension in magic_numbers:
+        if head.startswith(magic, offset):
+            return extension
+    if svg_pattern.match(head):
+        return '.svg'
+    return None
+
+class RendererIndex:
+    """ Looks up which renderers to try for a file by its extension (or, for files without a known extension, by the format its first
+        bytes show), so finding them doesn't call every renderer's is_supported.
+
+        Renderers with a supported_extensions method are indexed by the extensions it returns. Renderers without one,
+        or that return None (like an IconSet with a fallback icon), are kept in every chain and asked with is_supported.
+        Extensions are matched case-insensitively. """
+
+    def __init__(self, renderers):
+        self._chains = {}
+        self._fallback = []
+
+        extensions = []
+        for renderer in renderers:
+            supported = renderer.supported_extensions() if hasattr(renderer, 'supported_extensions') else None
+            extensions.append(None if supported is None else {x.lower() for x in supported})
+            if supported is None:
+                self._fallback.append((renderer, True))
+
+        for extension in set().union(*(x for x in extensions if x is not None)):
+            self._chains[extension] = [(renderer, supported is None) for renderer, supported in zip(renderers, extensions) if supported is None or extension in supported]
+
+    def chain(self, uri):
+        """ The renderers to try for the uri in order, as (renderer, needs is_supported check) pairs. """
+        chain = self._chains.get(os.path.splitext(uri)[1].lower())
+        if chain is not None:
+            return chain
+        file = uri_to_path(uri)
+        if file is not None:
+            chain = self._chains.get(sniff_extension(file))
+            if chain is not None:
+                return chain
+        return self._fallback
+
+    def renderers(self, uri):
+        """ The renderers that will be tried for the uri, in order. """
+        return [renderer for renderer, check in self.chain(uri) if not check or renderer.is_supported(uri)]
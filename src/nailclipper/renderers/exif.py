@@ -0,0 +1,67 @@
+from io import BytesIO
+from pathlib import Path
+from warnings import warn
+from PIL import Image, ExifTags
+from nailclipper.renderers.utils import uri_to_path, apply_orientation, EXIF_ORIENTATION
+
+EXIF_THUMBNAIL_OFFSET = 0x0201
+EXIF_THUMBNAIL_LENGTH = 0x0202
+
+class ExifRenderer:
+    """ Uses the preview image embedded in the EXIF data (IFD1) when it is big enough, which avoids decoding the full image. """
+
+    extensions = ['.jpg', '.jpeg', '.jpe', '.jfif']
+
+    # How much the aspect ratio of the preview may differ from the main image. Some cameras store
+    # letterboxed previews (4:3 preview of a 3:2 photo), those would give thumbnails with black bars.
+    aspect_tolerance = 0.02
+
+    @staticmethod
+    def init():
+        pass
+
+    @staticmethod
+    def is_supported(uri):
+        return Path(uri).suffix.lower() in ExifRenderer.extensions
+
+    @staticmethod
+    def supported_extensions():
+        return ExifRenderer.extensions
+
+    @staticmethod
+    def render(uri, size):
+        file = uri_to_path(uri)
+        if file is None:
+            return None
+        try:
+            # Opening only parses the headers, so no pixels of the main image are decoded here
+            with Image.open(file) as image:
+                exif_data = image.info.get('exif')
+                if not exif_data:
+                    return None
+                exif = image.getexif()
+                thumbnail_info = exif.get_ifd(ExifTags.IFD.IFD1)
+                offset = thumbnail_info.get(EXIF_THUMBNAIL_OFFSET)
+                length = thumbnail_info.get(EXIF_THUMBNAIL_LENGTH)
+                if not offset or not length:
+                    return None
+
+                # Offsets are relative to the TIFF header, which follows the 'Exif\0\0' marker
+                if exif_data.startswith(b'Exif\x00\x00'):
+                    exif_data = exif_data[6:]
+                preview = Image.open(BytesIO(exif_data[offset:offset + length]))
+                preview.load()
+
+                if abs(preview.size[0] / preview.size[1] - image.size[0] / image.size[1]) > ExifRenderer.aspect_tolerance * image.size[0] / image.size[1]:
+                    return None
+
+                preview = apply_orientation(preview, exif.get(EXIF_ORIENTATION))
+
+                # Big enough if it covers the size, a preview that only fits one side would be upscaled on the other (FILL crops to the whole size)
+                if preview.size[0] < size[0] or preview.size[1] < size[1]:
+                    return None
+
+                return preview
+        except Exception as e:
+            warn(f'Could not read embedded thumbnail of {file} using ExifRenderer: {e}')
+            return None
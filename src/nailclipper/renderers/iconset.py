@@ -1,8 +1,9 @@
+import os
 from pathlib import Path
-import shutil
-import itertools
 import copy
-from tkinter.constants import E
+import threading
+from PIL import Image
+from nailclipper.renderers.utils import uri_to_path, reduce_to_cover
 
 balmy_file_icons_dir = Path(__file__).parents[1] / 'data/balmy-icons'
 
@@ -52,32 +53,75 @@ class IconSet:
             self.categories = categories
         else:
             self.categories = copy.deepcopy(IconSet.default_categories)
+        self._extension_categories = None
+        # Decoded icons, reduced to each size they were rendered at, keyed by (icon, modification time, size)
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        # The cache stays behind when sent to worker processes
+        state = self.__dict__.copy()
+        del state['_cache'], state['_cache_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = {}
+        self._cache_lock = threading.Lock()
 
     def init(self):
         for x in self.categories.keys():
             if x not in self.icons.keys():
                 raise KeyError(f"'{x}' file category has no associated icon.")
+        self._extension_categories = IconSet._index_categories(self.categories)
 
     def is_supported(self, uri):
         if None in self.icons:
             return True
         else:
-            return Path(uri).suffix in list(itertools.chain.from_iterable(self.categories.values()))
+            return Path(uri).suffix in self._categories_by_extension()
 
-    def get_category(self, file):
-        ext = Path(file).suffix
-        cats = [x for x in self.categories if ext in self.categories[x]]
-        if len(cats):
-            return cats[0]
-        else:
+    def supported_extensions(self):
+        # With an icon for files of no category it supports every file
+        if None in self.icons:
             return None
+        return list(self._categories_by_extension().keys())
 
-    def from_url(self, url, size, save_path):
-        return self.from_file(url, size, save_path)
+    def get_category(self, file):
+        return self._categories_by_extension().get(Path(file).suffix)
 
-    def from_file(self, file, size, save_path):
+    def _categories_by_extension(self):
+        # Built by init, changes to the categories made after it aren't seen until init is called again
+        if self._extension_categories is None:
+            self._extension_categories = IconSet._index_categories(self.categories)
+        return self._extension_categories
+
+    @staticmethod
+    def _index_categories(categories):
+        """ Maps each extension to the first category that lists it. """
+        extension_categories = {}
+        for category, extensions in categories.items():
+            for extension in extensions:
+                extension_categories.setdefault(extension, category)
+        return extension_categories
+
+    def render(self, uri, size):
         try:
-            shutil.copy(self.icons[self.get_category(file)], save_path)
-            return True
+            key = self.render_key(uri, size)
+            with self._cache_lock:
+                image = self._cache.get(key)
+            if image is None:
+                image = Image.open(key[0])
+                image.load()
+                image = reduce_to_cover(image, size)
+                with self._cache_lock:
+                    self._cache[key] = image
+            # Don't hand out the cached icon itself
+            return image.copy()
         except:
-            return False
+            return None
+
+    def render_key(self, uri, size):
+        """ Returns a key for the image render gives the uri, which is the same for all files that get the same icon. """
+        icon = self.icons[self.get_category(uri_to_path(uri) or uri)]
+        return (str(icon), os.stat(icon).st_mtime_ns, tuple(size))
@@ -0,0 +1,134 @@
+import os
+import queue
+import threading
+import multiprocessing
+from warnings import warn
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, workers run without a memory limit there
+    resource = None
+
+def _worker_main(connection, renderer, memory_limit):
+    """ Main loop of a worker process, renders (uri, size) jobs from the connection and sends back the image (or None). """
+
+    if resource is not None and memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    renderer.init()
+
+    while True:
+        try:
+            uri, size = connection.recv()
+        except EOFError:
+            return
+        try:
+            image = renderer.render(uri, size)
+            if image is not None:
+                image.load()
+            connection.send(('ok', image))
+        except Exception as e:
+            connection.send(('error', f'{type(e).__name__}: {e}'))
+
+class _Worker:
+
+    def __init__(self, context, renderer, memory_limit):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_connection, renderer, memory_limit), daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def kill(self):
+        self.connection.close()
+        self.process.kill()
+        self.process.join()
+
+class IsolatedRenderer:
+    """ Runs another renderer in a pool of reusable worker processes, so a file that makes it hang, use too much memory or crash
+        can't take down the thumbnail manager. A render that takes longer than timeout seconds is killed, and each worker's address
+        space is limited to memory_limit bytes (where the platform supports it). Workers that are killed or crash are started again.
+        A render that doesn't finish returns None, so it's recorded as a failed thumbnail like any other file that can't be rendered.
+
+        The wrapped renderer must have a render method and be picklable. """
+
+    def __init__(self, renderer, timeout=30, memory_limit=2*1024**3, workers=None):
+        if type(renderer) == type:
+            renderer = renderer()
+        self.renderer = renderer
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.workers = workers or os.cpu_count() or 1
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes stay with the instance that started them, a copy sent to another process starts its own
+        state = self.__dict__.copy()
+        del state['_context'], state['_idle'], state['_started'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(state['renderer'], state['timeout'], state['memory_limit'], state['workers'])
+
+    def __del__(self):
+        if hasattr(self, '_idle'):
+            self.close()
+
+    def init(self):
+        # The renderer is also loaded here since is_supported can depend on it
+        self.renderer.init()
+
+    def is_supported(self, uri):
+        return self.renderer.is_supported(uri)
+
+    def supported_extensions(self):
+        return self.renderer.supported_extensions() if hasattr(self.renderer, 'supported_extensions') else None
+
+    def render(self, uri, size):
+
+        worker = self._acquire()
+
+        try:
+            worker.connection.send((uri, size))
+            if not worker.connection.poll(self.timeout):
+                warn(f'Could not generate thumbnail for {uri} using {type(self.renderer).__name__}: rendering took longer than {self.timeout} seconds')
+                worker = self._replace(worker)
+                return None
+            status, result = worker.connection.recv()
+        except (EOFError, OSError):
+            worker.process.join(1)
+            warn(f'Could not generate thumbnail for {uri} using {type(self.renderer).__name__}: worker process exited with code {worker.process.exitcode}')
+            worker = self._replace(worker)
+            return None
+        finally:
+            self._idle.put(worker)
+
+        if status == 'error':
+            warn(f'Could not generate thumbnail for {uri} using {type(self.renderer).__name__}: {result}')
+            return None
+
+        return result
+
+    def close(self):
+        """ Stops the worker processes, new ones are started if it's used again. """
+        with self._lock:
+            while True:
+                try:
+                    self._idle.get_nowait().kill()
+                except queue.Empty:
+                    break
+                self._started -= 1
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle.empty() and self._started < self.workers:
+                self._started += 1
+                return _Worker(self._context, self.renderer, self.memory_limit)
+        return self._idle.get()
+
+    def _replace(self, worker):
+        worker.kill()
+        return _Worker(self._context, self.renderer, self.memory_limit)
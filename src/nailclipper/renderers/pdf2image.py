@@ -1,10 +1,22 @@
+import os
+import re
+import math
+import threading
+from collections import OrderedDict
 from pathlib import Path
 from warnings import warn
+from nailclipper.renderers.utils import uri_to_path, reduce_to_cover
 
 class Pdf2ImageRenderer:
 
     p2i = None
 
+    # The first pages rendered most recently are kept, so thumbnails of the same file at other sizes
+    # (such as the Freedesktop normal and large thumbnails) don't rasterise it again. Set to 0 to disable.
+    cache_size = 8
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
     @staticmethod
     def init():
         try:
@@ -18,11 +30,70 @@ class Pdf2ImageRenderer:
         return Path(uri).suffix == '.pdf'
 
     @staticmethod
-    def from_file(file, size, save_path):
+    def supported_extensions():
+        return ['.pdf']
+
+    @staticmethod
+    def render(uri, size):
+        file = uri_to_path(uri)
+        if file is None:
+            return None
         try:
-            image = Pdf2ImageRenderer.p2i.convert_from_path(file, single_file=True)[0]
-            image.save(save_path)
-            return True
+            file_stat = os.stat(file)
+            key = (str(file), file_stat.st_mtime_ns, file_stat.st_size)
+
+            page = Pdf2ImageRenderer._cached_page(key, size)
+            if page is None:
+                page = Pdf2ImageRenderer._rasterize(file, size)
+                Pdf2ImageRenderer._cache_page(key, size, page)
+
+            image = reduce_to_cover(page, size)
+            # Don't hand out the cached page itself
+            return image.copy() if image is page else image
         except Exception as e:
             warn(f'Could not generate thumbnail from {file} using Pdf2ImageRenderer: {e}')
-            return False
\ No newline at end of file
+            return None
+
+    @staticmethod
+    def page_dpi(info, size):
+        """ The lowest DPI at which the first page covers the size, from the pdfinfo of the file. Returns None if the page size is unknown. """
+        # Like '595.276 x 841.89 pts (A4)', in points (1/72 of an inch) before the page rotation is applied
+        match = re.match(r'([\d.]+) x ([\d.]+)', str(info.get('Page size', '')))
+        if match is None:
+            return None
+        width, height = float(match[1]), float(match[2])
+        if int(info.get('Page rot', 0)) % 180 == 90:
+            width, height = height, width
+        return math.ceil(72 * max(size[0] / width, size[1] / height))
+
+    @staticmethod
+    def _rasterize(file, size):
+        """ Renders only the first page at the size, straight to memory (pdftoppm output is read from its stdout). """
+        dpi = Pdf2ImageRenderer._first_page_dpi(file, size)
+        if dpi is None:
+            # Scale the longest side to the size
+            return Pdf2ImageRenderer.p2i.convert_from_path(file, first_page=1, last_page=1, single_file=True, size=max(size))[0]
+        return Pdf2ImageRenderer.p2i.convert_from_path(file, dpi=dpi, first_page=1, last_page=1, single_file=True)[0]
+
+    @staticmethod
+    def _first_page_dpi(file, size):
+        # Without a page range pdfinfo reports the first page as 'Page size' and 'Page rot', with one it only prints per page keys like 'Page    1 size'
+        return Pdf2ImageRenderer.page_dpi(Pdf2ImageRenderer.p2i.pdfinfo_from_path(file), size)
+
+    @staticmethod
+    def _cached_page(key, size):
+        """ Returns the cached first page of the file if it was rendered for a size at least as large, otherwise None. """
+        with Pdf2ImageRenderer._cache_lock:
+            cached = Pdf2ImageRenderer._cache.get(key)
+            if cached is None or cached[0][0] < size[0] or cached[0][1] < size[1]:
+                return None
+            Pdf2ImageRenderer._cache.move_to_end(key)
+            return cached[1]
+
+    @staticmethod
+    def _cache_page(key, size, page):
+        with Pdf2ImageRenderer._cache_lock:
+            Pdf2ImageRenderer._cache[key] = (size, page)
+            Pdf2ImageRenderer._cache.move_to_end(key)
+            while len(Pdf2ImageRenderer._cache) > Pdf2ImageRenderer.cache_size:
+                Pdf2ImageRenderer._cache.popitem(last=False)
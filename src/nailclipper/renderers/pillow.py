@@ -1,32 +1,58 @@
 from pathlib import Path
 from warnings import warn
+from nailclipper.renderers.utils import uri_to_path, apply_orientation, reduce_to_cover, EXIF_ORIENTATION
 
 class PillowRenderer:
 
     pil = None
+    extensions = frozenset()
+
+    # Images larger than this many pixels (after any reduced-scale decoding) are skipped
+    # so a single huge file can't use up all of a worker's memory. Set to None to disable.
+    max_pixels = 100_000_000
 
     @staticmethod
     def init():
         try:
             import PIL
+            from PIL import Image
             PillowRenderer.pil = PIL
+            # Listing the extensions loads every plugin, so it's only done once
+            PillowRenderer.extensions = frozenset(x for x, y in Image.registered_extensions().items() if y in Image.OPEN)
         except Exception as e:
             warn(f'Could not load PillowRenderer: {e}')
 
     @staticmethod
     def is_supported(uri):
-        if PillowRenderer.pil:
-            return Path(uri).suffix in [x for x, y in PillowRenderer.pil.Image.registered_extensions().items() if y in PillowRenderer.pil.Image.OPEN]
-        else:
-            return False
+        return Path(uri).suffix in PillowRenderer.extensions
+
+    @staticmethod
+    def supported_extensions():
+        return PillowRenderer.extensions
 
     @staticmethod
-    def from_file(file, size, save_path):
+    def render(uri, size):
+        file = uri_to_path(uri)
+        if file is None:
+            return None
         try:
-            image = PillowRenderer.pil.Image.open(file)
-            image.thumbnail(size)
-            image.save(save_path)
-            return True
+            with PillowRenderer.pil.Image.open(file) as image:
+
+                # The size to cover is in the stored (not yet rotated) orientation of the image
+                orientation = image.getexif().get(EXIF_ORIENTATION)
+                stored_size = (size[1], size[0]) if orientation in [5, 6, 7, 8] else size
+
+                # Lets decoders that support it (JPEG DCT scaling) decode at the smallest scale that still covers the size
+                image.draft(None, stored_size)
+
+                if PillowRenderer.max_pixels and image.size[0] * image.size[1] > PillowRenderer.max_pixels:
+                    warn(f'Could not generate thumbnail for {file} using PillowRenderer: {image.size[0]}x{image.size[1]} image is larger than the {PillowRenderer.max_pixels} pixel limit')
+                    return None
+
+                image.load()
+                image = reduce_to_cover(image, stored_size)
+
+                return apply_orientation(image, orientation)
         except Exception as e:
             warn(f'Could not generate thumbnail for {file} using PillowRenderer: {e}')
-            return False
+            return None
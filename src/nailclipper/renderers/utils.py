@@ -0,0 +1,39 @@
+from pathlib import Path
+from urllib.parse import urlparse, unquote
+from PIL import Image
+
+def uri_to_path(uri):
+    """ Returns the local path of a file uri, or None for any other uri. """
+    parsed = urlparse(uri)
+    if parsed.scheme != 'file':
+        return None
+    return Path(unquote(parsed.path))
+
+def reduce_to_cover(image, size):
+    """ Cheaply shrinks the image by the largest integer factor that still leaves it covering the size. """
+    factor = min(image.size[0] // size[0], image.size[1] // size[1])
+    if factor < 2:
+        return image
+    if image.mode not in ['L', 'LA', 'RGB', 'RGBA', 'CMYK', 'YCbCr', 'I', 'F']:
+        image = image.convert('RGBA')
+    return image.reduce(factor)
+
+EXIF_ORIENTATION = 0x0112
+
+# EXIF orientation values and the transpose that undoes each one (same as PIL.ImageOps.exif_transpose)
+orientation_transposes = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90
+}
+
+def apply_orientation(image, orientation):
+    """ Rotates/flips the image so it displays upright for the given EXIF orientation value. """
+    transpose = orientation_transposes.get(orientation)
+    if transpose:
+        image = image.transpose(transpose)
+    return image
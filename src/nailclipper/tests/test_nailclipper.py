@@ -1,7 +1,7 @@
 import unittest as ut
-from nailclipper import ThumbnailManager, ThumbnailGenerator
+from nailclipper import ThumbnailManager, ThumbnailGenerator, ThumbnailIndex, SQLiteStore, MemoryStore, ThumbnailScheduler, PngEncoder, WebpEncoder, JpegEncoder
 from nailclipper.enums import *
-from nailclipper.renderers import IconSet
+from nailclipper.renderers import IconSet, ExifRenderer, PillowRenderer, IsolatedRenderer, Pdf2ImageRenderer, CairoRenderer
 from pathlib import Path
 from tempfile import TemporaryDirectory
 import tomllib
@@ -10,8 +10,56 @@ import shutil
 import itertools
 import math
 import sys
+import asyncio
+import time
+import warnings
+import struct
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from hashlib import md5
 from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+from nailclipper.png_text import read_png_text, add_png_text
+from nailclipper.encoders import read_metadata
+from nailclipper.thumbnail import Thumbnail
+
+def save_exif_thumbnail_jpeg(path, image, preview, orientation=1):
+    """ Saves a JPEG with the preview embedded in its EXIF data as an IFD1 thumbnail. """
+    preview_bytes = BytesIO()
+    preview.save(preview_bytes, 'jpeg')
+    preview_bytes = preview_bytes.getvalue()
+    # TIFF header, IFD0 with the orientation, IFD1 with the thumbnail offset and length, then the thumbnail itself
+    ifd0 = struct.pack('<H', 1) + struct.pack('<HHLHH', 0x0112, 3, 1, orientation, 0) + struct.pack('<L', 26)
+    ifd1 = struct.pack('<H', 2) + struct.pack('<HHLL', 0x0201, 4, 1, 56) + struct.pack('<HHLL', 0x0202, 4, 1, len(preview_bytes)) + struct.pack('<L', 0)
+    tiff = b'II*\x00' + struct.pack('<L', 8) + ifd0 + ifd1 + preview_bytes
+    image.save(path, 'jpeg', exif=b'Exif\x00\x00' + tiff)
+
+class HangingRenderer:
+    """ Renderer that never finishes, for testing IsolatedRenderer. """
+    init = staticmethod(lambda: None)
+    is_supported = staticmethod(lambda uri: True)
+    render = staticmethod(lambda uri, size: time.sleep(3600))
+
+class CrashingRenderer:
+    """ Renderer that takes down its process, for testing IsolatedRenderer. """
+    init = staticmethod(lambda: None)
+    is_supported = staticmethod(lambda uri: True)
+    render = staticmethod(lambda uri, size: os._exit(1))
+
+class SlowRenderer:
+    """ Renderer that counts its renders and takes a while, for testing that concurrent requests only render once. """
+    renders = 0
+    lock = threading.Lock()
+    init = staticmethod(lambda: PillowRenderer.init())
+    is_supported = staticmethod(lambda uri: True)
+    @staticmethod
+    def render(uri, size):
+        with SlowRenderer.lock:
+            SlowRenderer.renders += 1
+        time.sleep(0.2)
+        return PillowRenderer.render(uri, size)
 
 class ThumbnailManagerTestCase(ut.TestCase):
 
@@ -106,6 +154,89 @@ class ThumbnailManagerTestCase(ut.TestCase):
             im_size = im.size
         self.assertEqual(max(im_size), Size.NORMAL[0], f'Thumbnail size does not match requested size.')
 
+    def test_thumbnail_batch(self):
+        files = [x for x in self.test_files if x.suffix == '.jpg']
+        for executor in ['thread', 'process']:
+            results = list(self.tm.get_thumbnails(files + files[:1], workers=2, executor=executor))
+            self.assertEqual(len(results), len(files) + 1, f'Batch with {executor} executor did not return a result for every uri.')
+            for uri, thumbnail in results:
+                self.generated_thumbnails.append(thumbnail)
+                self.assertTrue(thumbnail, f'Batch thumbnail creation for {uri} with {executor} executor failed.')
+                self.assertEqual(thumbnail, self.tm.get_thumbnail(uri), f'Batch thumbnail for {uri} does not match single thumbnail.')
+
+    def test_thumbnail_async(self):
+        files = [x for x in self.test_files if x.suffix == '.jpg']
+        async def get_all():
+            return await asyncio.gather(*(self.tm.get_thumbnail_async(x) for x in files + files))
+        thumbnails = asyncio.run(get_all())
+        for file, thumbnail in zip(files + files, thumbnails):
+            self.generated_thumbnails.append(thumbnail)
+            self.assertTrue(thumbnail, f'Async thumbnail creation for {file} failed.')
+            self.assertEqual(thumbnail, self.tm.get_thumbnail(file), f'Async thumbnail for {file} does not match single thumbnail.')
+
+    def test_stale_revalidate(self):
+        file = self.test_dir / 'red.jpg'
+        thumbnail = self.tm.get_thumbnail(file)
+        self.generated_thumbnails.append(thumbnail)
+        with Image.open(thumbnail) as im:
+            color_1 = im.getcolors()
+
+        self.tm.stale_policy = StalePolicy.REVALIDATE
+        self.addCleanup(setattr, self.tm, 'stale_policy', StalePolicy.REFRESH)
+        shutil.copy(self.test_dir / 'green.jpg', file)
+        self.assertEqual(self.tm.get_thumbnail(file), thumbnail, 'Stale thumbnail was not returned.')
+        self.assertEqual(self.tm.get_thumbnail(file), thumbnail, 'Stale thumbnail was not returned.')
+        self.assertLessEqual(len(self.tm._revalidating), 1, 'Revalidations of the same thumbnail were not coalesced.')
+        for future in list(self.tm._revalidating.values()):
+            future.result()
+
+        thumbnail = self.tm.get_thumbnail(file)
+        with Image.open(thumbnail) as im:
+            color_2 = im.getcolors()
+        self.assertNotEqual(color_1, color_2, 'Stale thumbnail was not created again in the background.')
+
+    def test_check_directory(self):
+        red, green, blue = (self.test_dir / x for x in ['red.jpg', 'green.jpg', 'blue.jpg'])
+        self.generated_thumbnails.append(self.tm.get_thumbnail(red))
+        self.generated_thumbnails.append(self.tm.get_thumbnail(green))
+        shutil.copy(blue, green)
+        (self.test_dir / 'broken.jpg').write_bytes(b'not an image')
+        ThumbnailGenerator.create_fail_thumbnail((self.test_dir / 'broken.jpg').as_uri(), self.tm._thumbnail_fail_path((self.test_dir / 'broken.jpg').as_uri()))
+        status = self.tm.check_directory(self.test_dir)
+        self.assertIn(red.as_uri(), status[ThumbnailStatus.FRESH], 'Up-to-date thumbnail not reported as fresh.')
+        self.assertIn(green.as_uri(), status[ThumbnailStatus.STALE], 'Thumbnail of changed file not reported as stale.')
+        self.assertIn(blue.as_uri(), status[ThumbnailStatus.MISSING], 'File without thumbnail not reported as missing.')
+        self.assertIn((self.test_dir / 'broken.jpg').as_uri(), status[ThumbnailStatus.FAILED], 'Failed thumbnail not reported as failed.')
+        for uri, thumbnail in self.tm.get_thumbnails(status[ThumbnailStatus.STALE] + status[ThumbnailStatus.MISSING]):
+            self.generated_thumbnails.append(thumbnail)
+        status = self.tm.check_directory(self.test_dir)
+        self.assertIn(green.as_uri(), status[ThumbnailStatus.FRESH], 'Regenerated thumbnail not reported as fresh.')
+        self.assertIn(blue.as_uri(), status[ThumbnailStatus.FRESH], 'Generated thumbnail not reported as fresh.')
+
+    def test_collect_garbage(self):
+        red, green, blue = (self.test_dir / x for x in ['red.jpg', 'green.jpg', 'blue.jpg'])
+        thumbnails = {}
+        for file, atime in [(red, 1000), (green, 3000), (blue, 2000)]:
+            thumbnails[file] = self.tm.get_thumbnail(file)
+            self.generated_thumbnails.append(thumbnails[file])
+            os.utime(thumbnails[file], (atime, os.stat(thumbnails[file]).st_mtime))
+        red_size = os.stat(thumbnails[red]).st_size
+        blue_size = os.stat(thumbnails[blue]).st_size
+        red.unlink()
+
+        report = self.tm.collect_garbage()
+        self.assertGreaterEqual(report['orphaned'], 1, 'Thumbnail of deleted file was not reported as orphaned.')
+        self.assertEqual(report['evicted'], 0, 'Thumbnails were evicted without a quota.')
+        self.assertGreaterEqual(report['bytes'], red_size, 'Reclaimed bytes not reported.')
+        self.assertFalse(thumbnails[red].exists(), 'Thumbnail of deleted file was not removed.')
+        self.assertTrue(thumbnails[green].exists() and thumbnails[blue].exists(), 'Thumbnails of existing files were removed.')
+
+        report = self.tm.collect_garbage(max_entries=1)
+        self.assertEqual(report['evicted'], 1, 'Thumbnail cache was not evicted down to the entry quota.')
+        self.assertEqual(report['bytes'], blue_size, 'Reclaimed bytes not as expected.')
+        self.assertFalse(thumbnails[blue].exists(), 'Least recently used thumbnail was not evicted first.')
+        self.assertTrue(thumbnails[green].exists(), 'Most recently used thumbnail was evicted.')
+
 class FreedesktopThumbnailManagerTestCase(ThumbnailManagerTestCase):
 
     def setUp(self):
@@ -127,11 +258,151 @@ class FreedesktopThumbnailManagerTestCase(ThumbnailManagerTestCase):
                 im_size = im.size
             self.assertEqual(max(im_size), size[0], f'Thumbnail size does not match requested size.')
 
+    def test_thumbnail_set(self):
+        file = self.test_dir / 'red.jpg'
+        thumbnails = self.tm.get_thumbnail_set(file)
+        self.generated_thumbnails.extend(thumbnails.values())
+        for dir, size in [('normal', Size.NORMAL), ('large', Size.LARGE), ('x-large', Size.XLARGE), ('xx-large', Size.XXLARGE)]:
+            thumbnail = thumbnails[size]
+            self.assertEqual(thumbnail.parent, self.test_cache_dir / dir, f'Thumbnail of size "{dir}" {size} was put in the wrong directory.')
+            with Image.open(thumbnail) as im:
+                self.assertEqual(max(im.size), size[0], f'Thumbnail size does not match requested size.')
+                self.assertLess(math.dist(im.getpixel((0, 0)), (255, 0, 0, 255)), 3, f'Thumbnail of size "{dir}" does not match source image.')
+            self.assertEqual(thumbnail, self.tm.get_thumbnail(file, size), f'Thumbnail of size "{dir}" from set does not match single thumbnail.')
+        self.assertEqual(thumbnails[None], thumbnails[Size.NORMAL], 'Styles sharing a cache folder got different thumbnails.')
+
+    @ut.skip('Collecting garbage would remove the user\'s real thumbnails from the Freedesktop cache directory')
+    def test_collect_garbage(self):
+        pass
+
+class IndexedThumbnailManagerTestCase(ThumbnailManagerTestCase):
+    def setUp(self):
+        self.configure(thumbnail_manager=ThumbnailManager(index=ThumbnailIndex()), test_file_globs=['red.jpg', 'green.jpg', 'blue.jpg', 'red.png', 'green.png', 'blue.png'])
+        super().setUp()
+
+class ShardedThumbnailManagerTestCase(ThumbnailManagerTestCase):
+    def setUp(self):
+        self.configure(thumbnail_manager=ThumbnailManager(cache_layout=CacheLayout.SHARDED), test_file_globs=['red.jpg', 'green.jpg', 'blue.jpg', 'red.png', 'green.png', 'blue.png'])
+        super().setUp()
+
+    def test_thumbnail_sizes(self):
+        thumbnail = self.tm.get_thumbnail(self.test_files[0])
+        self.generated_thumbnails.append(thumbnail)
+        self.assertEqual(thumbnail.parent, self.test_cache_dir / thumbnail.name[0:2] / thumbnail.name[2:4], f'Thumbnail was put in the wrong shard directory.')
+
+    def test_migrate_cache_layout(self):
+        flat_tm = ThumbnailManager()
+        flat_thumbnails = [flat_tm.get_thumbnail(file) for file in self.test_files]
+        broken = (self.test_dir / 'broken.jpg').as_uri()
+        (self.test_dir / 'broken.jpg').write_bytes(b'not an image')
+        ThumbnailGenerator.create_fail_thumbnail(broken, flat_tm._thumbnail_fail_path(broken))
+        self.assertEqual(self.tm.migrate_cache_layout(CacheLayout.FLAT, workers=4), len(self.test_files) + 1, 'Not every thumbnail was migrated.')
+        for file, flat_thumbnail in zip(self.test_files, flat_thumbnails):
+            self.assertFalse(flat_thumbnail.exists(), f'Flat thumbnail for {file} was not moved.')
+            self.assertTrue(self.tm._thumbnail_path(file.as_uri(), None).exists(), f'Sharded thumbnail for {file} does not exist.')
+        self.assertTrue(self.tm._has_failed(broken), 'Fail thumbnail was not migrated.')
+        self.assertEqual(flat_tm.migrate_cache_layout(CacheLayout.SHARDED), len(self.test_files) + 1, 'Not every thumbnail was migrated back.')
+        self.assertEqual(sorted(x.name for x in self.test_cache_dir.iterdir()), sorted([x.name for x in flat_thumbnails] + ['fail']), 'Empty shard folders were not removed.')
+
 class ImageThumbnailManagerTestCase(ThumbnailManagerTestCase):
     def setUp(self):
         self.configure(thumbnail_manager=ThumbnailManager.image_thumbnail_manager(), test_file_globs=['red.jpg', 'green.jpg', 'blue.jpg', 'red.png', 'green.png', 'blue.png'])
         super().setUp()
 
+    def test_thumbnail_retry(self):
+        broken = self.test_dir / 'broken.jpg'
+        broken.write_bytes(b'not an image')
+        fail_path = self.tm._thumbnail_fail_path(broken.as_uri())
+        attempts = lambda: read_png_text(fail_path)['X-Nailclipper::Attempts']
+
+        self.tm.retry_policy = RetryPolicy.BACKOFF(base=3600)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.assertIsNone(self.tm.get_thumbnail(broken), 'Thumbnail was returned for a broken file.')
+            self.assertIsNone(self.tm.get_thumbnail(broken), 'Thumbnail was returned for a broken file.')
+            self.assertEqual(attempts(), '1', 'Broken file was retried before the backoff delay.')
+
+            self.tm.retry_policy = RetryPolicy.ALWAYS
+            self.assertIsNone(self.tm.get_thumbnail(broken), 'Thumbnail was returned for a broken file.')
+            self.assertEqual(attempts(), '2', 'Retry of broken file was not counted.')
+
+        self.tm.retry_policy = RetryPolicy.NEVER
+        shutil.copy('red.jpg', broken)
+        thumbnail = self.tm.get_thumbnail(broken)
+        self.generated_thumbnails.append(thumbnail)
+        self.assertTrue(thumbnail, 'Fail thumbnail was not invalidated when the file changed.')
+        self.assertFalse(fail_path.exists(), 'Fail thumbnail was not removed after a successful render.')
+
+    def test_stale_fallback(self):
+        file = self.test_dir / 'red.jpg'
+        thumbnail = self.tm.get_thumbnail(file)
+        self.generated_thumbnails.append(thumbnail)
+        file.write_bytes(b'not an image')
+        self.tm.stale_policy = StalePolicy.FALLBACK
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.assertEqual(self.tm.get_thumbnail(file), thumbnail, 'Stale thumbnail was not returned when it could not be created again.')
+            self.tm.stale_policy = StalePolicy.REFRESH
+            self.assertIsNone(self.tm.get_thumbnail(file), 'Stale thumbnail was returned with the refresh stale policy.')
+
+    def test_encoder(self):
+        tm = ThumbnailManager(thumbnail_generators={None: ThumbnailGenerator(encoder=WebpEncoder(lossless=True))}, cache_dir=CacheDir.TEMP, refresh_policy=RefreshPolicy.FREEDESKTOP)
+        thumbnail = tm.get_thumbnail(self.test_dir / 'red.jpg')
+        self.assertEqual(thumbnail.suffix, '.webp', 'WebP thumbnail was not saved with its suffix.')
+        with Image.open(thumbnail) as im:
+            self.assertEqual(im.format, 'WEBP', 'Thumbnail was not encoded as WebP.')
+        self.assertEqual(tm.check_directory(self.test_dir)[ThumbnailStatus.FRESH], [(self.test_dir / 'red.jpg').as_uri()], 'WebP thumbnail metadata was not read back.')
+
+        freedesktop = ThumbnailManager.freedesktop_thumbnail_manager('nailclipper', '0')
+        for encoder in [WebpEncoder(), JpegEncoder(), PngEncoder(colors=256)]:
+            freedesktop.thumbnail_generators[Size.LARGE].encoder = encoder
+            self.assertFalse(Compliance.FREEDESKTOP(freedesktop), f'{type(encoder).__name__} was accepted by the Freedesktop compliance check.')
+
+    def test_thumbnail_batch_styling(self):
+        tg = ThumbnailGenerator(size=(48, 48), resize_style=ResizeStyle.FILL, background='red_bg.png', foreground='blue_fg.png', mask='mask.png')
+        batch = ThumbnailManager(thumbnail_generators={None: tg}, cache_dir=self.test_dir / 'batch')
+        single = ThumbnailManager(thumbnail_generators={None: tg}, cache_dir=self.test_dir / 'single')
+        for uri, thumbnail in batch.get_thumbnails(self.test_files, workers=1):
+            self.assertEqual(thumbnail.read_bytes(), single.get_thumbnail(uri).read_bytes(), f'Batch thumbnail for {uri} does not match single thumbnail.')
+
+    def test_thumbnail_set_renderers(self):
+        # The larger style renders an icon, the smaller one can't be downscaled from it
+        generators = {None: ThumbnailGenerator(renderers=[PillowRenderer]), 'icon': ThumbnailGenerator(renderers=[IconSet], size=Size.LARGE)}
+        tm = ThumbnailManager(thumbnail_generators=generators, cache_folders={None: '.', 'icon': 'icon'}, cache_dir=self.test_dir / 'set')
+        thumbnails = tm.get_thumbnail_set(self.test_dir / 'red.jpg')
+        for style in generators:
+            single = ThumbnailManager(thumbnail_generators=generators, cache_folders={None: '.', 'icon': 'icon'}, cache_dir=self.test_dir / 'single').get_thumbnail(self.test_dir / 'red.jpg', style)
+            with Image.open(thumbnails[style]) as a, Image.open(single) as b:
+                self.assertEqual(a.size, b.size, f'Thumbnail of style {style} from set does not match single thumbnail.')
+                self.assertEqual(a.tobytes(), b.tobytes(), f'Thumbnail of style {style} from set does not match single thumbnail.')
+        with Image.open(thumbnails[None]) as im:
+            self.assertLess(math.dist(im.getpixel((0, 0)), (255, 0, 0, 255)), 3, 'Thumbnail was downscaled from a style with other renderers.')
+
+    def test_file_locks(self):
+        # Separate managers stand in for separate processes sharing the cache directory
+        managers = [ThumbnailManager(thumbnail_generators={None: ThumbnailGenerator(renderers=[SlowRenderer])}, cache_dir=self.test_dir / 'shared', file_locks=True) for _ in range(4)]
+        SlowRenderer.renders = 0
+        with ThreadPoolExecutor(len(managers)) as pool:
+            thumbnails = list(pool.map(lambda tm: tm.get_thumbnail(self.test_dir / 'red.jpg'), managers))
+        self.assertEqual(SlowRenderer.renders, 1, 'Thumbnail was rendered by more than one manager at once.')
+        self.assertEqual(len(set(thumbnails)), 1, 'Managers did not return the same thumbnail.')
+        with Image.open(thumbnails[0]) as im:
+            im.verify()
+        leftovers = [x.name for x in thumbnails[0].parent.iterdir() if x != thumbnails[0]]
+        self.assertEqual(leftovers, [], 'Temporary or lock files were left in the cache directory.')
+
+    def test_retry_policy(self):
+        now = time.time()
+        self.assertFalse(RetryPolicy.BACKOFF(base=60)(1, now - 30), 'Retried before the first backoff delay.')
+        self.assertTrue(RetryPolicy.BACKOFF(base=60)(1, now - 90), 'Not retried after the first backoff delay.')
+        self.assertFalse(RetryPolicy.BACKOFF(base=60, factor=2)(3, now - 200), 'Backoff delay did not grow with the attempts.')
+        self.assertTrue(RetryPolicy.BACKOFF(base=60, max_delay=100)(10, now - 200), 'Backoff delay was not capped.')
+        self.assertFalse(RetryPolicy.BACKOFF(max_attempts=3)(3, 0), 'Retried after the maximum number of attempts.')
+        freedesktop = ThumbnailManager.freedesktop_thumbnail_manager('nailclipper', '0')
+        self.assertEqual(freedesktop.retry_policy, RetryPolicy.NEVER, 'Freedesktop thumbnail manager retries failed files before they change.')
+        freedesktop.retry_policy = RetryPolicy.BACKOFF
+        self.assertFalse(Compliance.FREEDESKTOP_STRICT(freedesktop), 'Retrying unchanged failed files was accepted by the strict Freedesktop compliance check.')
+
 class SimpleThumbnailManagerTestCase(ThumbnailManagerTestCase):
     def setUp(self):
         self.configure(thumbnail_manager=ThumbnailManager.simple_thumbnail_manager())
@@ -173,9 +444,162 @@ class IconThumbnailManagerTestCase(ThumbnailManagerTestCase):
                     thumbnail_hash = md5().update(f.read())
                 self.assertEqual(thumbnail_hash, icon_hash)
 
+    def test_shared_thumbnail(self):
+        shutil.copy(self.test_dir / 'script.sh', self.test_dir / 'other.sh')
+        tg = self.tm.thumbnail_generators[None]
+        tg._shared_thumbnails.clear()
+        thumbnails = [self.tm.get_thumbnail(self.test_dir / x) for x in ['script.sh', 'other.sh']]
+        self.assertEqual(len(tg._shared_thumbnails), 1, 'Icon thumbnail was encoded more than once.')
+        with Image.open(thumbnails[0]) as a, Image.open(thumbnails[1]) as b:
+            self.assertEqual(a.tobytes(), b.tobytes(), 'Files with the same icon got different thumbnails.')
+            self.assertEqual(b.text['Thumb::URI'], (self.test_dir / 'other.sh').resolve().as_uri(), 'Thumbnail metadata is not for its own file.')
+
+class StoreThumbnailManagerTestCase(ut.TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.test_dir = Path(self.tempdir.name)
+        shutil.copytree(Path(__file__).parent / 'resources', self.test_dir, dirs_exist_ok=True)
+        os.chdir(self.test_dir)
+        self.addCleanup(self.tempdir.cleanup)
+        self.tm = ThumbnailManager(store=SQLiteStore(self.test_dir / 'thumbnails.db'))
+
+    def test_thumbnail_creation(self):
+        for file, expected_color in [('red.jpg', (255, 0, 0, 255)), ('green.jpg', (0, 255, 0, 255)), ('blue.jpg', (0, 0, 255, 255))]:
+            thumbnail = self.tm.get_thumbnail(file)
+            self.assertIsInstance(thumbnail, memoryview, f'Stored thumbnail for {file} is not a memoryview.')
+            with Image.open(BytesIO(thumbnail)) as im:
+                self.assertLess(math.dist(im.getcolors()[0][1], expected_color), 3, f'Stored thumbnail for {file} does not match source image.')
+                self.assertEqual(max(im.size), Size.NORMAL[0], f'Stored thumbnail size for {file} does not match requested size.')
+                self.assertEqual(im.text['Thumb::URI'], (self.test_dir / file).as_uri(), f'Stored thumbnail for {file} is missing metadata.')
+        self.assertFalse(Path('./cache').exists(), 'Thumbnail files were written with a thumbnail store.')
+
+    def test_thumbnail_refresh(self):
+        key = self.tm._store_key((self.test_dir / 'red.jpg').as_uri(), None)
+        thumbnail_1 = bytes(self.tm.get_thumbnail('red.jpg'))
+        created_1 = self.tm.store.lookup(key)['created']
+        thumbnail_2 = bytes(self.tm.get_thumbnail('red.jpg'))
+        created_2 = self.tm.store.lookup(key)['created']
+        shutil.copy('green.jpg', 'red.jpg')
+        with Image.open(BytesIO(self.tm.get_thumbnail('red.jpg'))) as im:
+            color_3 = im.getcolors()[0][1]
+        created_3 = self.tm.store.lookup(key)['created']
+        self.assertEqual(created_1, created_2, 'New thumbnail was stored with no change in source file.')
+        self.assertEqual(thumbnail_1, thumbnail_2, 'Stored thumbnails do not match with no change in source file.')
+        self.assertGreater(created_3, created_1, 'New thumbnail was NOT stored when source file changed.')
+        self.assertLess(math.dist(color_3, (0, 255, 0, 255)), 3, 'New thumbnail after altered source file does not match the altered file.')
+
+    def test_remote_thumbnail(self):
+        uri = 'https://example.com/red.jpg'
+        data = bytes(self.tm.get_thumbnail('red.jpg'))
+        for refresh_policy in [RefreshPolicy.FREEDESKTOP, RefreshPolicy.AUTO, RefreshPolicy.INTERVAL]:
+            tm = ThumbnailManager(store=self.tm.store, refresh_policy=refresh_policy)
+            tm.store.put(tm._store_key(uri, None), data, {'Thumb::URI': uri})
+            self.assertEqual(bytes(tm.get_thumbnail(uri)), data, f'Stored thumbnail of a remote uri was not returned with {refresh_policy}.')
+
+    def test_thumbnail_fail(self):
+        Path('broken.jpg').write_bytes(b'not an image')
+        with self.assertWarns(UserWarning):
+            self.assertIsNone(self.tm.get_thumbnail('broken.jpg'), 'Thumbnail was returned for a broken file.')
+        self.assertTrue(self.tm._has_failed((self.test_dir / 'broken.jpg').as_uri()), 'Failed thumbnail was not recorded in the store.')
+
+    def test_thumbnail_batch(self):
+        files = ['red.jpg', 'green.jpg', 'blue.jpg', 'red_bg.png', 'green_mg.png', 'blue_fg.png']
+        results = dict(self.tm.get_thumbnails(files, workers=4))
+        self.assertEqual(len(results), len(files), 'Batch did not return a result for every file.')
+        for uri, thumbnail in results.items():
+            self.assertEqual(bytes(thumbnail), bytes(self.tm.get_thumbnail(uri)), f'Batch thumbnail for {uri} does not match single thumbnail.')
+        status = self.tm.check_directory(self.test_dir)
+        self.assertTrue(set(results).issubset(status[ThumbnailStatus.FRESH]), 'Stored thumbnails not reported as fresh.')
+
+    def test_collect_garbage(self):
+        for file in ['red.jpg', 'green.jpg', 'blue.jpg']:
+            self.tm.get_thumbnail(file)
+        Path('red.jpg').unlink()
+        report = self.tm.collect_garbage(max_entries=1)
+        self.assertEqual((report['orphaned'], report['evicted']), (1, 1), 'Stored thumbnails were not collected as expected.')
+        self.assertGreater(report['bytes'], 0, 'Reclaimed bytes not reported.')
+        self.assertEqual(len(self.tm.store.entries('.')), 1, 'Store was not evicted down to the entry quota.')
+
+class MemoryStoreThumbnailManagerTestCase(StoreThumbnailManagerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tm = ThumbnailManager(store=MemoryStore())
+
+    def test_write_behind(self):
+        backing = SQLiteStore(self.test_dir / 'thumbnails.db')
+        store = MemoryStore(max_bytes=1500, backing=backing)
+        tm = ThumbnailManager(store=store)
+        thumbnails = {file: bytes(tm.get_thumbnail(file)) for file in ['red.jpg', 'green.jpg', 'blue.jpg']}
+        self.assertLessEqual(store.size, store.max_bytes, 'Memory store grew past its size limit.')
+        self.assertLess(len(store._entries), 3, 'Least recently used thumbnail was not dropped from memory.')
+        store.flush()
+        for file, thumbnail in thumbnails.items():
+            key = tm._store_key((self.test_dir / file).as_uri(), None)
+            self.assertEqual(bytes(backing.get(key)), thumbnail, f'Thumbnail for {file} was not written behind.')
+            self.assertEqual(bytes(tm.get_thumbnail(file)), thumbnail, f'Thumbnail for {file} was not read back from the backing store.')
+
 #class ThumbnailRenderersTest(ThumbnailManagerTestCaseBase):
 #    pass
 
+class ThumbnailSchedulerTestCase(ut.TestCase):
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.test_dir = Path(self.tempdir.name)
+        shutil.copytree(Path(__file__).parent / 'resources', self.test_dir, dirs_exist_ok=True)
+        os.chdir(self.test_dir)
+        self.addCleanup(self.tempdir.cleanup)
+        self.tm = ThumbnailManager.image_thumbnail_manager()
+
+    def test_priority(self):
+        scheduler = ThumbnailScheduler(self.tm, workers=1)
+        self.addCleanup(scheduler.shutdown)
+        red, green, blue, green_mg = 'red.jpg', 'green.jpg', 'blue.jpg', 'green_mg.png'
+        order = []
+        # Holding the lock keeps the worker from starting before everything is queued
+        with scheduler._condition:
+            handles = {file: scheduler.request(file, priority=i) for i, file in enumerate([red, green, blue, green_mg])}
+            scheduler.reprioritize(handles[red], 10)
+            scheduler.cancel(handles[green])
+            for file in [red, blue, green_mg]:
+                handles[file].add_done_callback(lambda handle, file=file: order.append(file))
+        for file in [red, blue, green_mg]:
+            self.assertTrue(handles[file].result(timeout=30), f'Scheduled thumbnail creation for {file} failed.')
+        self.assertEqual(order, [red, green_mg, blue], 'Requests were not handled in order of priority.')
+        self.assertTrue(handles[green].cancelled(), 'Cancelled request was not cancelled.')
+        self.assertFalse(self.tm._thumbnail_path((self.test_dir / green).as_uri(), None).exists(), 'Thumbnail of cancelled request was created.')
+
+    def test_max_queued(self):
+        scheduler = ThumbnailScheduler(self.tm, workers=1, max_queued=2)
+        self.addCleanup(scheduler.shutdown)
+        with scheduler._condition:
+            handles = [scheduler.request(file, priority=i) for i, file in enumerate(['blue.jpg', 'red.jpg', 'green.jpg'])]
+        self.assertTrue(handles[0].cancelled(), 'Lowest priority request was not dropped from a full queue.')
+        self.assertTrue(handles[1].result(timeout=30) and handles[2].result(timeout=30), 'Scheduled thumbnail creation failed.')
+
+        with scheduler._condition:
+            handles = [scheduler.request(file, priority=i) for i, file in enumerate(['blue_fg.png', 'red_bg.png'])]
+            scheduler.reprioritize(handles[0], 5)
+            # Cancelling the handle itself frees its place in the queue
+            handles[1].cancel()
+            handles.append(scheduler.request('green_mg.png', priority=1))
+            handles.append(scheduler.request('mask.png', priority=0))
+        self.assertTrue(handles[3].cancelled(), 'Lowest priority request was not dropped from a full queue.')
+        self.assertFalse(handles[0].cancelled() or handles[2].cancelled(), 'Request was dropped while the queue had room for it.')
+        self.assertTrue(handles[0].result(timeout=30) and handles[2].result(timeout=30), 'Scheduled thumbnail creation failed.')
+
+    def test_cancel_before_save(self):
+        uri = (self.test_dir / 'red.jpg').as_uri()
+        checks = []
+        # Not cancelled before rendering, then cancelled before saving
+        cancelled = lambda: checks.append(None) or len(checks) > 1
+        self.assertIsNone(self.tm._update_thumbnail(uri, None, cancelled), 'Cancelled thumbnail was returned.')
+        self.assertEqual(len(checks), 2, 'Cancellation was not checked before rendering and saving.')
+        self.assertFalse(self.tm._thumbnail_path(uri, None).exists(), 'Cancelled thumbnail was saved.')
+        self.assertFalse(self.tm._thumbnail_fail_path(uri).exists(), 'Cancelled thumbnail was recorded as failed.')
+
 class ThumbnailGeneratorTestCase(ut.TestCase):
 
     def setUp(self):
@@ -288,6 +712,59 @@ class ThumbnailGeneratorTestCase(ut.TestCase):
             self.assertEqual(im.getpixel((255, 0)), (0, 0, 255, 255), 'Color of top right corner of test color background thumbnail not as expected.')
             self.assertEqual(im.getpixel((255, 255)), (255, 0, 0, 255), 'Color of bottom right corner of test color background thumbnail not as expected.')
 
+    def test_asset_cache(self):
+        tg = ThumbnailGenerator(size=(64, 64), resize_style=ResizeStyle.FILL, background='bg.png', mask='mask.png')
+        Image.new('RGBA', (300, 300), (255, 0, 0, 255)).save('bg.png')
+        for file in ['blue_fg.png', 'blue_fg.png', 'green_mg.png']:
+            image = tg.create_thumbnail_image((self.test_dir / file).as_uri())
+        self.assertEqual(len(tg._assets), 2, 'Background and mask were not reused between thumbnails.')
+        self.assertEqual(image.getpixel((0, 32)), (0, 0, 0, 0), 'Mask was not applied.')
+
+        Image.new('RGBA', (300, 300), (0, 0, 255, 255)).save('bg.png')
+        os.utime('bg.png', ns=(0, 0))
+        image = tg.create_thumbnail_image((self.test_dir / 'blue_fg.png').as_uri())
+        self.assertEqual(image.getpixel((20, 20)), (0, 0, 255, 255), 'Changed background file was not used.')
+
+        tg.resample = Resample.NEAREST
+        tg.create_thumbnail_image((self.test_dir / 'blue_fg.png').as_uri())
+        self.assertEqual(len(tg._assets), 5, 'Assets were not resized again when the settings changed.')
+
+    def test_thumbnail_images(self):
+        images = [Image.open(self.test_dir / x) for x in ['red.jpg', 'green_mg.png', 'resize.png', 'blue_fg.png', 'red_bg.png']] + [None]
+        for resize_style in ['FILL', 'FIT', 'PADDING']:
+            tg = ThumbnailGenerator(size=(48, 48), resize_style=getattr(ResizeStyle, resize_style), background='red_bg.png', foreground=(0, 0, 255, 100), mask='mask.png')
+            expected = [tg.create_thumbnail_image(None, x) if x else None for x in images]
+            for styled, image in zip(tg.create_thumbnail_images(images), expected):
+                self.assertEqual(styled and styled.tobytes(), image and image.tobytes(), f'Batch styled image does not match single styled image with ResizeStyle.{resize_style}.')
+        self.assertTrue(tg._strips, 'Images of the same size were not styled as a strip.')
+
+    def test_hidden_background(self):
+        tg = ThumbnailGenerator(size=(64, 64), resize_style=ResizeStyle.FILL, background=(0, 0, 255, 255))
+        opaque = Image.new('RGB', (128, 128), (255, 0, 0))
+        self.assertEqual(tg.create_thumbnail_image(None, opaque).getpixel((32, 32)), (255, 0, 0, 255), 'Opaque image was not put over the background.')
+        transparent = Image.new('RGBA', (128, 128), (255, 0, 0, 0))
+        self.assertEqual(tg.create_thumbnail_image(None, transparent).getpixel((32, 32)), (0, 0, 255, 255), 'Background was not composited under a transparent image.')
+        tg.resize_style = ResizeStyle.PADDING
+        padded = tg.create_thumbnail_image(None, Image.new('RGB', (128, 64), (255, 0, 0)))
+        self.assertEqual((padded.getpixel((32, 2)), padded.getpixel((32, 32))), ((0, 0, 255, 255), (255, 0, 0, 255)), 'Background was not composited around an opaque image that does not cover it.')
+
+    def test_encoders(self):
+        image = Image.new('RGBA', (64, 64), (255, 0, 0, 128))
+        image.paste((0, 0, 255, 255), (0, 0, 32, 32))
+        metadata = {'Thumb::URI': 'file:///tmp/red%20square.png', 'Thumb::MTime': '1700000000.5'}
+        for encoder in [PngEncoder(compress_level=1, strategy=zlib.Z_RLE), PngEncoder(optimize=True), PngEncoder(colors=16), WebpEncoder(lossless=True), JpegEncoder()]:
+            path = self.test_dir / f'encoded{encoder.suffix}'
+            path.write_bytes(encoder.encode(image, metadata))
+            self.assertEqual(read_metadata(path), metadata, f'Metadata of {type(encoder).__name__} thumbnail not read back.')
+            with Image.open(path) as im:
+                self.assertEqual(im.format, encoder.format, f'{type(encoder).__name__} thumbnail has the wrong format.')
+                # JPEG thumbnails are put on a white background
+                expected = [(0, 0, 255), (255, 127, 127)] if encoder.format == 'JPEG' else [(0, 0, 255, 255), (255, 0, 0, 128)]
+                for position, color in zip([(8, 8), (48, 48)], expected):
+                    self.assertLess(math.dist(im.convert('RGB' if encoder.format == 'JPEG' else 'RGBA').getpixel(position), color), 4, f'{type(encoder).__name__} thumbnail colors not as expected.')
+        with Image.open(self.test_dir / 'encoded.png') as im:
+            self.assertEqual(im.mode, 'P', 'Quantized thumbnail does not use a palette.')
+
     def test_size(self):
         tg = ThumbnailGenerator(size=(64, 64), resize_style=ResizeStyle.FILL)
         thumbnail = tg.create_thumbnail(self.test_dir / 'red.jpg', self.cache_dir / 'test_size_64x64.jpg')
@@ -319,6 +796,160 @@ class ThumbnailGeneratorTestCase(ut.TestCase):
         with Image.open(thumbnail) as im:
             self.assertEqual(im.size, (1024, 256), '1024x256 test size thumbnail size not as expected.')
 
+    def test_file_renderer(self):
+        class CopyRenderer:
+            def init(self):
+                pass
+            def is_supported(self, uri):
+                return True
+            def from_file(self, file, size, save_path):
+                shutil.copy(file, save_path)
+                return True
+        tg = ThumbnailGenerator(size=(64, 64), renderers=[CopyRenderer])
+        tg.init()
+        thumbnail = tg.create_thumbnail(self.test_dir / 'red_bg.png', self.cache_dir / 'test_file_renderer.png')
+        with Image.open(thumbnail) as im:
+            self.assertEqual(im.getpixel((32, 32)), (255, 0, 0, 255), 'Thumbnail from file based renderer not as expected.')
+
+    def test_thumbnail_paths(self):
+        tg = ThumbnailGenerator(renderers=[PillowRenderer])
+        for file in ['red.jpg', self.test_dir / 'red.jpg']:
+            image = tg.create_thumbnail_image(file)
+            self.assertLess(math.dist(image.getcolors()[0][1], (255, 0, 0, 255)), 3, f'Thumbnail image of path {file!r} does not match source image.')
+            with Image.open(BytesIO(tg.create_thumbnail_data(file))) as im:
+                self.assertEqual(im.text['Thumb::URI'], (self.test_dir / 'red.jpg').resolve().as_uri(), f'Thumbnail data of path {file!r} does not have the uri of the file.')
+
+    def test_isolated_renderer(self):
+        renderer = IsolatedRenderer(PillowRenderer, workers=1)
+        self.addCleanup(renderer.close)
+        renderer.init()
+        tg = ThumbnailGenerator(renderers=[renderer])
+        thumbnail = tg.create_thumbnail_image((self.test_dir / 'red.jpg').as_uri())
+        self.assertLess(math.dist(thumbnail.getcolors()[0][1], (255, 0, 0, 255)), 3, 'Isolated thumbnail does not match source image.')
+
+        for broken_renderer in [HangingRenderer, CrashingRenderer]:
+            broken = IsolatedRenderer(broken_renderer, timeout=1, workers=1)
+            self.addCleanup(broken.close)
+            with self.assertWarns(UserWarning):
+                self.assertIsNone(broken.render((self.test_dir / 'red.jpg').as_uri(), Size.NORMAL), f'Isolated {broken_renderer.__name__} returned an image.')
+            self.assertEqual(broken._idle.qsize(), 1, 'Broken worker process was not replaced.')
+            self.assertTrue(broken._idle.queue[0].process.is_alive(), 'Broken worker process was not replaced.')
+
+    def test_pdf_page_dpi(self):
+        a4 = {'Page size': '595.276 x 841.89 pts (A4)', 'Page rot': '0'}
+        self.assertEqual(Pdf2ImageRenderer.page_dpi(a4, Size.NORMAL), 16, 'Page DPI does not cover the requested size.')
+        self.assertEqual(Pdf2ImageRenderer.page_dpi(a4, (256, 64)), 31, 'Page DPI does not cover the requested size.')
+        self.assertEqual(Pdf2ImageRenderer.page_dpi(dict(a4, **{'Page rot': '90'}), (256, 64)), 22, 'Page rotation was not taken into account.')
+        self.assertIsNone(Pdf2ImageRenderer.page_dpi({}, Size.NORMAL), 'Page DPI returned for an unknown page size.')
+
+    def test_pdf_page_dpi_pdfinfo(self):
+        # Stands in for poppler's pdfinfo with its captured output, which has per page keys instead when a page range is given
+        pdfinfo = self.test_dir / 'bin' / 'pdfinfo'
+        pdfinfo.parent.mkdir()
+        pdfinfo.write_text(f'''#!{sys.executable}
+import sys
+page = 'Page    1 ' if '-l' in sys.argv else 'Page '
+print(f"""Producer:       GPL Ghostscript 9.55.0
+Tagged:         no
+UserProperties: no
+Suspects:       no
+Form:           none
+JavaScript:     no
+Pages:          3
+Encrypted:      no
+{{page}}size:      595.276 x 841.89 pts (A4)
+{{page}}rot:       0
+File size:      18473 bytes
+Optimized:      no
+PDF version:    1.7""")
+''')
+        pdfinfo.chmod(0o755)
+        self.addCleanup(os.environ.__setitem__, 'PATH', os.environ['PATH'])
+        os.environ['PATH'] = f'{pdfinfo.parent}{os.pathsep}{os.environ["PATH"]}'
+        Pdf2ImageRenderer.init()
+        self.assertEqual(Pdf2ImageRenderer._first_page_dpi(self.test_dir / 'red.pdf', Size.NORMAL), 16, 'Page DPI was not read from the pdfinfo output.')
+
+    def test_svg_output_size(self):
+        self.assertEqual(CairoRenderer.output_size((1000, 500), Size.NORMAL), (256, 128), 'SVG output size does not cover the requested size.')
+        self.assertEqual(CairoRenderer.output_size((16, 32), Size.LARGE), (256, 512), 'Small SVG was not rendered at the requested size.')
+        self.assertEqual(CairoRenderer.output_size(None, Size.LARGE), (None, None), 'SVG without a size was given an output size.')
+
+    def test_renderers_for(self):
+        icons = IconSet(icons={k: v for k, v in IconSet.default_icons.items() if k is not None})
+        tg = ThumbnailGenerator(renderers=[ExifRenderer, PillowRenderer, Pdf2ImageRenderer, icons])
+        tg.init()
+        shutil.copy(self.test_dir / 'red.jpg', self.test_dir / 'red')
+        (self.test_dir / 'unknown').write_bytes(b'not an image')
+        self.assertEqual([type(x) for x in tg.renderers_for(self.test_dir / 'red.jpg')], [ExifRenderer, PillowRenderer, IconSet], 'Wrong renderers for a JPEG.')
+        self.assertEqual([type(x) for x in tg.renderers_for(self.test_dir / 'RED.PDF')], [Pdf2ImageRenderer, IconSet], 'Extensions were not matched case-insensitively.')
+        self.assertEqual([type(x) for x in tg.renderers_for(self.test_dir / 'script.sh')], [IconSet], 'Wrong renderers for a script.')
+        self.assertEqual([type(x) for x in tg.renderers_for(self.test_dir / 'red')], [ExifRenderer, PillowRenderer, IconSet], 'JPEG without an extension was not recognized.')
+        self.assertEqual(tg.renderers_for(self.test_dir / 'unknown'), [], 'Renderers returned for an unknown file.')
+        thumbnail = tg.create_thumbnail_image((self.test_dir / 'red').as_uri())
+        self.assertLess(math.dist(thumbnail.getcolors()[0][1], (255, 0, 0, 255)), 3, 'Thumbnail of a JPEG without an extension does not match source image.')
+
+    def test_max_pixels(self):
+        tg = ThumbnailGenerator(size=(64, 64), renderers=[PillowRenderer])
+        tg.init()
+        max_pixels = PillowRenderer.max_pixels
+        self.addCleanup(setattr, PillowRenderer, 'max_pixels', max_pixels)
+        PillowRenderer.max_pixels = 100
+        with self.assertWarns(UserWarning):
+            thumbnail = tg.create_thumbnail(self.test_dir / 'red.jpg', self.cache_dir / 'test_max_pixels.png')
+        self.assertIsNone(thumbnail, 'Thumbnail was created for image over the pixel limit.')
+
+    def test_exif_thumbnail(self):
+        save_exif_thumbnail_jpeg(self.test_dir / 'exif.jpg', Image.new('RGB', (1600, 1200), (255, 0, 0)), Image.new('RGB', (192, 144), (0, 0, 255)))
+        tg = ThumbnailGenerator(size=(128, 128))
+        tg.init()
+        thumbnail = tg.create_thumbnail(self.test_dir / 'exif.jpg', self.cache_dir / 'test_exif_normal.png')
+        with Image.open(thumbnail) as im:
+            self.assertLess(math.dist(im.getpixel((64, 48)), (0, 0, 255, 255)), 3, 'Embedded EXIF thumbnail was not used.')
+            self.assertEqual(im.size, (128, 96), 'EXIF thumbnail size not as expected.')
+
+        tg = ThumbnailGenerator(size=(256, 256))
+        tg.init()
+        thumbnail = tg.create_thumbnail(self.test_dir / 'exif.jpg', self.cache_dir / 'test_exif_large.png')
+        with Image.open(thumbnail) as im:
+            self.assertLess(math.dist(im.getpixel((128, 96)), (255, 0, 0, 255)), 3, 'Embedded EXIF thumbnail was used when too small.')
+
+        # Wide enough for the size but not tall enough
+        tg = ThumbnailGenerator(size=(160, 160))
+        tg.init()
+        thumbnail = tg.create_thumbnail(self.test_dir / 'exif.jpg', self.cache_dir / 'test_exif_cover.png')
+        with Image.open(thumbnail) as im:
+            self.assertLess(math.dist(im.getpixel((80, 60)), (255, 0, 0, 255)), 3, 'Embedded EXIF thumbnail was used when it does not cover the size.')
+
+    def test_exif_orientation(self):
+        save_exif_thumbnail_jpeg(self.test_dir / 'exif.jpg', Image.new('RGB', (1600, 1200), (255, 0, 0)), Image.new('RGB', (192, 144), (0, 0, 255)), orientation=6)
+        for size in [(128, 128), (256, 256)]:
+            tg = ThumbnailGenerator(size=size)
+            tg.init()
+            thumbnail = tg.create_thumbnail(self.test_dir / 'exif.jpg', self.cache_dir / f'test_exif_orientation_{size[0]}.png')
+            with Image.open(thumbnail) as im:
+                self.assertEqual(im.size, (size[0] * 3 // 4, size[1]), f'Orientation was not applied to {size} thumbnail.')
+
+    def test_png_text(self):
+        png_info = PngInfo()
+        png_info.add_text('Thumb::URI', 'file:///tmp/red.png')
+        png_info.add_text('Thumb::MTime', '1700000000.5', zip=True)
+        png_info.add_itxt('Thumb::Mimetype', 'image/png', lang='en', tkey='Mimetype')
+        png_info.add_itxt('Comment', 'Compressed \u00fcnicode', zip=True)
+        Image.new('RGBA', (8, 8)).save(self.test_dir / 'text.png', pnginfo=png_info)
+        with Image.open(self.test_dir / 'text.png') as im:
+            self.assertEqual(read_png_text(self.test_dir / 'text.png'), im.text, 'PNG text chunks not read as expected.')
+
+        thumbnail = Thumbnail(self.test_dir / 'text.png')
+        self.assertEqual(thumbnail.metadata, {'uri': 'file:///tmp/red.png', 'mtime': '1700000000.5', 'mimetype': 'image/png'}, 'Thumbnail metadata not as expected.')
+        self.assertIs(thumbnail.image, thumbnail.image, 'Thumbnail image was loaded more than once.')
+
+        data = BytesIO()
+        Image.new('RGBA', (8, 8), (255, 0, 0, 255)).save(data, 'png')
+        data = add_png_text(data.getvalue(), {'Thumb::URI': 'file:///tmp/red.png', 'Comment': '\u00fcnicode \u2713'})
+        with Image.open(BytesIO(data)) as im:
+            self.assertEqual(im.text, {'Thumb::URI': 'file:///tmp/red.png', 'Comment': '\u00fcnicode \u2713'}, 'Added PNG text chunks not read as expected.')
+            self.assertEqual(im.getpixel((0, 0)), (255, 0, 0, 255), 'Adding PNG text changed the image.')
+
 def print_suite(suite):
     if hasattr(suite, '__iter__'):
         for x in suite:
@@ -1,6 +1,7 @@
 from enum import Enum
 from PIL import ExifTags, Image
 from PIL.PngImagePlugin import PngInfo
+from nailclipper.png_text import read_png_text
 from nailclipper.enums import *
 
 MakernoteMetadataTags = {
@@ -19,31 +20,56 @@ PNGInfoKeys = {
 
 class Thumbnail:
     def __init__(self, path, image = None, metadata_format = MetadataFormat.PNG_INFO):
-        self.metadata = {}
         self.metadata_format = metadata_format
         self._image = image
+        self._metadata = {} if image is not None else None
         self.path = path
 
     @property
     def image(self):
-        self.load()
+        """ The thumbnail image, loaded from the file the first time it is accessed. """
+        if self._image is None:
+            with Image.open(self.path) as image:
+                image.load()
+                self._image = image
         return self._image
 
+    @property
+    def metadata(self):
+        """ The thumbnail metadata, read from the file the first time it is accessed. """
+        if self._metadata is None:
+            self._metadata = self._read_metadata()
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata
+
     def load(self):
-        self._image = Image.open(self.path)
+        """ (Re)loads the image and metadata from the thumbnail file. """
+        self._image = None
+        self._metadata = None
+        self.image
+        self.metadata
+
+    def _read_metadata(self):
         if self.metadata_format == MetadataFormat.EXIF:
-            exif_makernote = self._image.getexif().get_ifd(ExifTags.IFD.MakerNote)
-            self.metadata = { [x for x,y in MakernoteMetadataTags.items() if y==k][0]:v for k,v in exif_makernote.items()}
+            with Image.open(self.path) as image:
+                raw_metadata = image.getexif().get_ifd(ExifTags.IFD.MakerNote)
+            keys = {v:k for k,v in MakernoteMetadataTags.items()}
         elif self.metadata_format == MetadataFormat.PNG_INFO:
-            self.metadata = { [x for x,y in PNGInfoKeys.items() if y==k][0]:v for k,v in self._image.text.items()}
+            # Reading just the text chunks avoids decoding the image
+            raw_metadata = read_png_text(self.path)
+            keys = {v:k for k,v in PNGInfoKeys.items()}
+        return { keys[k]:v for k,v in raw_metadata.items() if k in keys }
 
     def save(self):
         if self.metadata_format == MetadataFormat.EXIF:
-            exif_makernote = self._image.getexif().get_ifd(ExifTags.IFD.MakerNote)
+            exif_makernote = self.image.getexif().get_ifd(ExifTags.IFD.MakerNote)
             exif_makernote.update({MakernoteMetadataTags[k]:v for k, v in self.metadata.items()})
-            self._image.save(self.path)
+            self.image.save(self.path)
         elif self.metadata_format == MetadataFormat.PNG_INFO:
             png_info = PngInfo()
             for k,v in self.metadata.items():
                 png_info.add_text(PNGInfoKeys[k], v)
-            self._image.save(self.path, pnginfo=png_info)
+            self.image.save(self.path, pnginfo=png_info)
@@ -1,26 +1,41 @@
 import os
+import time
+import threading
 import tempfile
 import mimetypes
 from pathlib import Path
+from collections import OrderedDict
 from urllib.parse import urlparse, unquote
 
 from PIL import Image
-from PIL.PngImagePlugin import PngInfo
 
-from nailclipper.renderers import PillowRenderer, Pdf2ImageRenderer, CairoRenderer
+from nailclipper.renderers import ExifRenderer, PillowRenderer, Pdf2ImageRenderer, CairoRenderer
+from nailclipper.renderers.dispatch import RendererIndex
+from nailclipper.png_text import add_png_text
+from nailclipper.encoders import PngEncoder
+from nailclipper.cache_files import write_atomic
 from nailclipper.enums import *
 
 class ThumbnailGenerator:
 
+    # How many resized mask, background and foreground images each generator keeps
+    asset_cache_size = 64
+
+    # How many strips of repeated layers each generator keeps for batches, and how large a strip of stacked images can get
+    # (larger ones no longer fit in the CPU cache, which makes them slower than styling the images one by one), see create_thumbnail_images
+    strip_cache_size = 8
+    strip_bytes = 256 * 1024
+
     def __init__(self,
-            renderers = [PillowRenderer, Pdf2ImageRenderer, CairoRenderer],
+            renderers = [ExifRenderer, PillowRenderer, Pdf2ImageRenderer, CairoRenderer],
             resize_style = ResizeStyle.FIT,
             mask = None,
             resample = Resample.AUTO,
             upscale = True,
             background = (0, 0, 0, 0),
             foreground = None,
-            size = Size.NORMAL):
+            size = Size.NORMAL,
+            encoder = PngEncoder()):
 
         #TODO: implement 'shared' thumbnails part of the Freedesktop spec
 
@@ -32,73 +47,308 @@ class ThumbnailGenerator:
         self.background = background
         self.foreground = foreground
         self.size = size
+        self.encoder = encoder
+
+        self.renderers = [x() if type(x) == type else x for x in self.renderers]
+
+        # Encoded thumbnails (without metadata) of images that renderers give many files, see create_thumbnail_data
+        self._shared_thumbnails = {}
+
+        # Built by init, once the renderers know what they support
+        self._renderer_index = None
 
-        if type(self.renderers[0]) == type:
-            self.renderers = [x() for x in self.renderers]
+        # Mask, background and foreground images resized for the thumbnails, see _asset
+        self._assets = OrderedDict()
+        self._assets_lock = threading.Lock()
+
+        # The layers repeated down strips for batches of thumbnails, see _strip
+        self._strips = OrderedDict()
+
+    def __getstate__(self):
+        # The resized assets stay behind when sent to worker processes
+        state = self.__dict__.copy()
+        del state['_assets'], state['_assets_lock'], state['_strips']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._assets = OrderedDict()
+        self._assets_lock = threading.Lock()
+        self._strips = OrderedDict()
 
     def init(self):
         for renderer in self.renderers:
             renderer.init()
+        self._renderer_index = RendererIndex(self.renderers)
 
-    def create_thumbnail(self, uri, save_path):
+    def renderers_for(self, uri):
+        """ The renderers that will be tried for the uri, in the order they are tried. The first one that gives an image is used. """
+        if len(urlparse(str(uri)).scheme) <= 1:
+            uri = Path(uri).resolve().as_uri()
+        if self._renderer_index is None:
+            return [renderer for renderer in self.renderers if renderer.is_supported(uri)]
+        return self._renderer_index.renderers(uri)
+
+    def create_thumbnail(self, uri, save_path, image=None, shared_key=None, styled=None):
+        """ Creates a thumbnail of the uri at save_path. If an already rendered image of the file is given it is used instead of rendering the file again,
+            and if it was already styled too (see create_thumbnail_images) that is given as styled. """
 
         if len(urlparse(str(uri)).scheme) <= 1:
             uri = Path(uri).resolve().as_uri()
 
         save_path.parent.mkdir(parents=True, exist_ok=True)
 
-        image = self._render_thumbnail(uri, self.size)
+        data = self.create_thumbnail_data(uri, image, shared_key, styled)
+
+        if data is None:
+            return data
+
+        write_atomic(save_path, data)
+
+        return save_path
+
+    def create_thumbnail_data(self, uri, image=None, shared_key=None, styled=None):
+        """ Renders, styles and encodes the thumbnail for the uri, returning the encoded data with its metadata (or None if it can't be rendered).
+
+            Renderers that give many files the same image (like IconSet) have a render_key method, returning a key for the image they render.
+            Thumbnails of those images are only styled and encoded once (for PNG), after that only the metadata of the file is added. """
+
+        if len(urlparse(str(uri)).scheme) <= 1:
+            uri = Path(uri).resolve().as_uri()
+
+        if image is None:
+            image, shared_key = self._render(uri, self.size)
+            if image is None:
+                return None
+
+        metadata = ThumbnailGenerator._thumbnail_metadata(uri)
+
+        if shared_key is not None and self.encoder.format == 'PNG':
+            shared_key = (shared_key, self._style_key())
+            data = self._shared_thumbnails.get(shared_key)
+            if data is None:
+                data = self.encoder.encode(self.create_thumbnail_image(uri, image) if styled is None else styled)
+                self._shared_thumbnails[shared_key] = data
+            return add_png_text(data, metadata)
+
+        return self.encoder.encode(self.create_thumbnail_image(uri, image) if styled is None else styled, metadata)
+
+    def create_thumbnail_image(self, uri, image=None):
+        """ Renders and styles the thumbnail for the uri, returning the image without saving it (or None if it can't be rendered).
+            The uri is only used to render the file, so it can be None when the rendered image is given. """
+
+        if image is None:
+            if len(urlparse(str(uri)).scheme) <= 1:
+                uri = Path(uri).resolve().as_uri()
+            image = self._render_thumbnail(uri, self.size)
 
         if image is None:
             return image
 
+        opaque = ThumbnailGenerator._is_opaque(image)
+
         image = image.convert('RGBA')
 
         image = self._resize_image(image, self.size, self.resize_style)
 
-        background = self._create_ground(self.background, image.size, self.size)
-        image = self._apply_layer(background, image)
+        return self._style_image(image, opaque, self._layers(image.size))
+
+    def create_thumbnail_images(self, images):
+        """ Styles a batch of rendered images, returning what create_thumbnail_image would for each (None for images that are None).
+
+            The layers are looked up once for each size of image in the batch. Small images of the same size are also stacked into
+            strips of up to strip_bytes, so the background, foreground and mask are each composited in a single pass over a strip
+            (against strips of the layers repeated, which are kept for the next batch) instead of once for every image. """
+
+        styled = [None] * len(images)
+        groups = {}
+
+        for i, image in enumerate(images):
+            if image is None:
+                continue
+            opaque = ThumbnailGenerator._is_opaque(image)
+            image = self._resize_image(image.convert('RGBA'), self.size, self.resize_style)
+            groups.setdefault(image.size, []).append((i, image, opaque))
+
+        for image_size, group in groups.items():
+            layers = self._layers(image_size)
+            if len(group) > 1 and self._is_stackable(image_size, layers):
+                width, height = ThumbnailGenerator._composited_size(layers)
+                count = max(1, ThumbnailGenerator.strip_bytes // (width * height * 4))
+                for start in range(0, len(group), count):
+                    chunk = group[start:start + count]
+                    if len(chunk) > 1:
+                        for (i, _, _), image in zip(chunk, self._style_strip([image for _, image, _ in chunk], layers)):
+                            styled[i] = image
+                    else:
+                        for i, image, opaque in chunk:
+                            styled[i] = self._style_image(image, opaque, layers)
+            else:
+                for i, image, opaque in group:
+                    styled[i] = self._style_image(image, opaque, layers)
+
+        return styled
+
+    def _layers(self, image_size):
+        """ The sizes and layers (colors or resized images) to style a resized image of image_size with, as
+            (background size, foreground size, background, foreground, mask). """
+
+        if self.resize_style == ResizeStyle.FIT:
+            background_size = tuple(image_size)
+        else:
+            background_size = tuple(self.size)
+
+        background = self._asset(self.background, background_size, ResizeStyle.FILL) if type(self.background) is str else self.background
+
+        # The image takes the size of the background it's put on (an image background can be smaller when not upscaling)
+        composited_size = background.size if isinstance(background, Image.Image) else background_size
 
-        if self.foreground:
-            foreground = self._create_ground(self.foreground, image.size, self.size)
+        foreground_size = composited_size if self.resize_style == ResizeStyle.FIT else tuple(self.size)
+        foreground = self._asset(self.foreground, foreground_size, ResizeStyle.FILL) if type(self.foreground) is str else self.foreground
+
+        mask = self._asset(self.mask, composited_size, ResizeStyle.STRETCH) if self.mask else None
+
+        return background_size, foreground_size, background, foreground, mask
+
+    def _style_image(self, image, opaque, layers):
+        """ Puts the resized image on the background and applies the foreground and mask. """
+
+        background_size, foreground_size, background, foreground, mask = layers
+
+        # An opaque image covering the background hides all of it, so then it isn't composited
+        if isinstance(background, Image.Image):
+            if not (opaque and background.size == image.size):
+                # Backgrounds are composited onto, so they get their own copy
+                image = self._apply_layer(background.copy(), image)
+        elif not (opaque and background_size == image.size):
+            image = self._apply_layer(Image.new('RGBA', background_size, background), image)
+
+        if foreground:
+            if not isinstance(foreground, Image.Image):
+                foreground = Image.new('RGBA', foreground_size, foreground)
             image = self._apply_layer(image, foreground)
 
-        if self.mask:
-            image = self._apply_mask(image, Image.open(self.mask))
+        if mask:
+            image = self._apply_mask(image, mask)
 
-        metadata = ThumbnailGenerator._thumbnail_metadata(uri)
+        return image
 
-        image.save(save_path, 'png', pnginfo=metadata)
+    @staticmethod
+    def _composited_size(layers):
+        background_size, _, background, _, _ = layers
+        return background.size if isinstance(background, Image.Image) else background_size
+
+    def _is_stackable(self, image_size, layers):
+        """ Checks that the images and layers all line up with the background, so the layers can be repeated down a strip. """
+        composited_size = ThumbnailGenerator._composited_size(layers)
+        _, foreground_size, _, foreground, _ = layers
+        if image_size[0] > composited_size[0] or image_size[1] > composited_size[1]:
+            return False
+        if foreground is None:
+            return True
+        return (foreground.size if isinstance(foreground, Image.Image) else foreground_size) == composited_size
+
+    def _style_strip(self, images, layers):
+        """ Styles images of the same size together, as one strip of images stacked on top of each other, and returns the styled images. """
+
+        _, _, background, foreground, mask = layers
+        width, height = ThumbnailGenerator._composited_size(layers)
+        count = len(images)
+
+        # Only transparent where the images don't cover the background (it's left uninitialized when they cover all of it)
+        covered = images[0].size == (width, height)
+        strip = Image.new('RGBA', (width, height * count), None if covered else (0, 0, 0, 0))
+        for n, image in enumerate(images):
+            strip.paste(image, (int((width - image.size[0]) / 2), n * height + int((height - image.size[1]) / 2)))
+
+        strip = Image.alpha_composite(self._strip(background, (width, height), count), strip)
+
+        if foreground:
+            strip = Image.alpha_composite(strip, self._strip(foreground, (width, height), count))
+
+        if mask:
+            strip = self._apply_mask(strip, self._strip(mask, (width, height), count))
+
+        return [strip.crop((0, n * height, width, (n + 1) * height)) for n in range(count)]
+
+    def _strip(self, layer, size, count):
+        """ Returns the layer (a color, or an image of size) repeated count times down a strip. The strip is shared, so it must not be modified. """
+
+        # Images are kept with the strip, as an id can be reused once the image is gone
+        key = (id(layer) if isinstance(layer, Image.Image) else layer, tuple(size), count)
+
+        with self._assets_lock:
+            cached = self._strips.get(key)
+            if cached is not None and (cached[0] is layer or not isinstance(layer, Image.Image)):
+                self._strips.move_to_end(key)
+                return cached[1]
+
+        if isinstance(layer, Image.Image):
+            strip = Image.new(layer.mode, (size[0], size[1] * count))
+            for n in range(count):
+                strip.paste(layer, (0, n * size[1]))
+        else:
+            strip = Image.new('RGBA', (size[0], size[1] * count), layer)
 
-        return save_path
+        with self._assets_lock:
+            self._strips[key] = (layer, strip)
+            self._strips.move_to_end(key)
+            while len(self._strips) > ThumbnailGenerator.strip_cache_size:
+                self._strips.popitem(last=False)
+
+        return strip
+
+    @staticmethod
+    def _is_opaque(image):
+        return 'A' not in image.getbands() and 'transparency' not in image.info
 
     def _render_thumbnail(self, uri, size):
+        return self._render(uri, size)[0]
 
-        parsed = urlparse(uri)
-        success = False
-        image = None
+    def _render(self, uri, size):
+        """ Renders the uri with the first renderer that can, returning the image and the renderer's render_key for it (if it has one). """
 
-        file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-        file.close()
-        path = file.name
+        if self._renderer_index is None:
+            chain = [(renderer, True) for renderer in self.renderers]
+        else:
+            chain = self._renderer_index.chain(uri)
 
-        for renderer in self.renderers:
-            if renderer.is_supported(uri):
+        for renderer, check in chain:
+            if not check or renderer.is_supported(uri):
+                if hasattr(renderer, 'render'):
+                    image = renderer.render(uri, size)
+                else:
+                    image = self._render_to_file(renderer, uri, size)
+                if image is not None:
+                    return image, renderer.render_key(uri, size) if hasattr(renderer, 'render_key') else None
 
-                # TODO: Clean this up, it tries generating with from_url if from_file doesn't work... which is an odd behavior I think since usually one calls the other
-                if parsed.scheme == 'file' and hasattr(renderer, 'from_file') and renderer.from_file(Path(parsed.path), size, file.name):
-                    success = True
-                    break
-                elif hasattr(renderer, 'from_url') and renderer.from_url(uri, size, file.name):
-                    success = True
-                    break
+        return None, None
 
-        if success:
-            image = Image.open(file.name)
+    def _style_key(self):
+        """ The options that change how a rendered image is styled. """
+        return (self.size, self.resize_style, self.mask, self.resample, self.upscale, self.background, self.foreground, type(self.encoder), tuple(vars(self.encoder).items()))
 
-        del file
+    def _render_options(self):
+        """ The options that change what is rendered for a uri, generators with equal options can share a rendered image (resized for each). """
+        return (self.upscale, [(type(renderer), {k: v for k, v in vars(renderer).items() if not k.startswith('_')}) for renderer in self.renderers])
 
-        return image
+    def _render_to_file(self, renderer, uri, size):
+        """ Fallback for renderers that can only write their output to a file (such as wrappers around external tools). """
+
+        parsed = urlparse(uri)
+        fd, path = tempfile.mkstemp(suffix='.png')
+        os.close(fd)
+
+        try:
+            # TODO: Clean this up, it tries generating with from_url if from_file doesn't work... which is an odd behavior I think since usually one calls the other
+            if ((parsed.scheme == 'file' and hasattr(renderer, 'from_file') and renderer.from_file(Path(unquote(parsed.path)), size, path))
+                or (hasattr(renderer, 'from_url') and renderer.from_url(uri, size, path))):
+                with Image.open(path) as image:
+                    image.load()
+                    return image
+            return None
+        finally:
+            os.unlink(path)
 
     def _apply_layer(self, image1, image2):
         pos = (
@@ -108,26 +358,35 @@ class ThumbnailGenerator:
         image1.alpha_composite(image2, pos)
         return image1
 
-    def _create_ground(self, ground, image_size, desired_size):
-        if self.resize_style == ResizeStyle.FIT:
-            bg_size = image_size
-        else:
-            bg_size = desired_size
-
-        if type(ground) is str:
-            ground = Image.open(ground)
-            ground = self._resize_image(ground, bg_size, ResizeStyle.FILL)
-        else:
-            ground = Image.new('RGBA', bg_size, ground)
-
-        return ground
-
     def _apply_mask(self, image, mask):
         masked = Image.new(image.mode, image.size, (0, 0, 0, 0))
-        mask = self._resize_image(mask, image.size, ResizeStyle.STRETCH)
         masked.paste(image, (0, 0), mask=mask)
         return masked
 
+    def _asset(self, path, size, resize_style):
+        """ Returns the image at path resized for a thumbnail, which is only done once for each size (and again when the file or the resize options change).
+            The image is shared, so it must not be modified. """
+
+        file_stat = os.stat(path)
+        key = (str(path), file_stat.st_mtime_ns, file_stat.st_size, tuple(size), resize_style, self.resample, self.upscale)
+
+        with self._assets_lock:
+            asset = self._assets.get(key)
+            if asset is not None:
+                self._assets.move_to_end(key)
+                return asset
+
+        with Image.open(path) as asset:
+            asset = self._resize_image(asset, size, resize_style)
+
+        with self._assets_lock:
+            self._assets[key] = asset
+            # With ResizeStyle.FIT there's a size for each aspect ratio of the files
+            while len(self._assets) > ThumbnailGenerator.asset_cache_size:
+                self._assets.popitem(last=False)
+
+        return asset
+
     def _resize_image(self, image, size, resize_style):
 
         resample = self.resample
@@ -183,21 +442,31 @@ class ThumbnailGenerator:
 
     @staticmethod
     def _thumbnail_metadata(uri):
-        metadata = PngInfo()
+        metadata = {}
         parsed = urlparse(uri)
         if parsed.scheme == 'file':
-            path = Path(unquote(parsed.path))
-            metadata.add_text('Thumb::MTime', str(os.stat(path).st_mtime))
-            metadata.add_text('Thumb::Size', str(os.path.getsize(path)))
-        metadata.add_text('Thumb::URI', uri)
+            file_stat = os.stat(Path(unquote(parsed.path)))
+            metadata['Thumb::MTime'] = str(file_stat.st_mtime)
+            metadata['Thumb::Size'] = str(file_stat.st_size)
+        metadata['Thumb::URI'] = uri
         mimetype = mimetypes.guess_type(uri, strict=False)[0]
         if mimetype is not None:
-            metadata.add_text('Thumb::Mimetype', mimetype)
+            metadata['Thumb::Mimetype'] = mimetype
         return metadata
 
     @staticmethod
-    def create_fail_thumbnail(uri, save_path):
+    def _fail_metadata(uri, attempts=1):
+        """ Metadata of a fail thumbnail, the usual metadata plus how many times rendering failed and when it last failed. """
+        metadata = ThumbnailGenerator._thumbnail_metadata(uri)
+        metadata['X-Nailclipper::Attempts'] = str(attempts)
+        metadata['X-Nailclipper::FailTime'] = str(time.time())
+        return metadata
+
+    @staticmethod
+    def create_fail_thumbnail(uri, save_path, attempts=1):
+        """ Creates a fail thumbnail for the uri at save_path and returns its metadata. """
         save_path.parent.mkdir(parents=True, exist_ok=True)
         image = Image.new('RGBA', (1, 1))
-        metadata = ThumbnailGenerator._thumbnail_metadata(uri)
-        image.save(save_path, 'png', pnginfo=metadata)
+        metadata = ThumbnailGenerator._fail_metadata(uri, attempts)
+        write_atomic(save_path, PngEncoder().encode(image, metadata))
+        return metadata
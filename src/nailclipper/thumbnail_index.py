@@ -0,0 +1,82 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+class IndexEntry:
+    """ What the index knows about the cached thumbnails of one uri. """
+
+    __slots__ = ['hash', 'thumbnails']
+
+    def __init__(self, uri):
+        md5 = hashlib.md5()
+        md5.update(uri.encode('ascii'))
+        self.hash = md5.hexdigest()
+        self.thumbnails = {} # style -> thumbnail metadata (the Thumb::* text of the PNG)
+
+class ThumbnailIndex:
+    """ An in-process LRU index of cached thumbnails, keyed by uri.
+        This lets cache hits skip opening the thumbnail, so a warm hit only needs to stat the source file.
+        The index assumes thumbnails are only changed through the thumbnail manager using it. """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def entry(self, uri):
+        """ Gets the entry for the uri, creating it if needed. """
+        with self._lock:
+            entry = self._entries.get(uri)
+            if entry is None:
+                entry = IndexEntry(uri)
+                self._entries[uri] = entry
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(uri)
+            return entry
+
+    def invalidate(self, uri):
+        with self._lock:
+            self._entries.pop(uri, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class FailCache:
+    """ An in-process LRU of the fail thumbnail metadata of files that couldn't be rendered, keyed by uri.
+        This lets repeated requests for those files be answered without touching the disk until a retry is due. """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, uri):
+        with self._lock:
+            metadata = self._entries.get(uri)
+            if metadata is not None:
+                self._entries.move_to_end(uri)
+            return metadata
+
+    def put(self, uri, metadata):
+        with self._lock:
+            self._entries[uri] = metadata
+            self._entries.move_to_end(uri)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, uri):
+        with self._lock:
+            self._entries.pop(uri, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,22 +1,147 @@
+import os
+import time
 import hashlib
+import threading
 import tempfile
 from pathlib import Path
+from contextlib import ExitStack
+from warnings import warn
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from nailclipper.renderers import *
+from nailclipper.renderers.utils import reduce_to_cover
 from nailclipper.thumbnail_generator import ThumbnailGenerator
+from nailclipper.png_text import read_png_text
+from nailclipper.encoders import read_metadata, suffixes
+from nailclipper.thumbnail_index import FailCache
+from nailclipper.cache_files import file_lock, fcntl
 from nailclipper.enums import *
 
 class ComplianceError(ValueError):
     pass
 
+def _normalize_uri(uri):
+    uri = str(uri)
+    if len(urlparse(uri).scheme) <= 1:
+        uri = Path(uri).resolve().as_uri()
+    return uri
+
+# The thumbnail generator and policies of a process pool worker. These are sent once when the worker starts rather than with every job,
+# so the generator's caches are kept between the jobs of a worker.
+_worker = None
+
+def _init_worker(thumbnail_generator, refresh_policy, retry_policy, file_locks):
+    global _worker
+    # Renderers keep their loaded modules on the class, so spawned worker processes need to load them again.
+    thumbnail_generator.init()
+    _worker = (thumbnail_generator, refresh_policy, retry_policy, file_locks)
+
+def _refresh_worker_thumbnail(uri, save_path, fail_path):
+    """ Runs _refresh_thumbnail in a process pool worker, with the generator and policies it was started with. """
+    thumbnail_generator, refresh_policy, retry_policy, file_locks = _worker
+    return _refresh_thumbnail(thumbnail_generator, refresh_policy, retry_policy, uri, save_path, fail_path, file_locks)
+
+def _refresh_thumbnail(thumbnail_generator, refresh_policy, retry_policy, uri, save_path, fail_path, file_locks=False):
+    """ Returns an up-to-date thumbnail for the uri, creating it if needed. Process pool workers run this through _refresh_worker_thumbnail. """
+
+    # The manager's stale_policy isn't applied in worker processes, these always wait for an up-to-date thumbnail.
+
+    if save_path.exists() and not refresh_policy(save_path, uri):
+        return save_path
+
+    if file_locks:
+        # Checked again once locked, another process may have created the thumbnail in the meantime
+        with file_lock(save_path):
+            return _refresh_thumbnail(thumbnail_generator, refresh_policy, retry_policy, uri, save_path, fail_path)
+
+    failure = _read_failure(fail_path, uri)
+
+    if failure is not None and not _should_retry(retry_policy, failure):
+        return None
+
+    thumbnail = thumbnail_generator.create_thumbnail(uri, save_path)
+
+    if not thumbnail:
+        ThumbnailGenerator.create_fail_thumbnail(uri, fail_path, _next_attempt(failure))
+    elif failure is not None:
+        fail_path.unlink(missing_ok=True)
+
+    return thumbnail
+
+def _read_failure(fail_path, uri, file_stat=None):
+    """ Returns the metadata of a fail thumbnail file, or None if there is none. A fail thumbnail of a file that changed since is removed. """
+    try:
+        metadata = read_png_text(fail_path)
+    except (FileNotFoundError, ValueError):
+        return None
+    if _is_outdated_failure(metadata, uri, file_stat):
+        fail_path.unlink(missing_ok=True)
+        return None
+    return metadata
+
+def _is_outdated_failure(metadata, uri, file_stat=None):
+    """ Checks if the file changed since it failed to render, in which case it's worth trying again right away. """
+    if urlparse(uri).scheme != 'file':
+        return False
+    try:
+        return is_stale_metadata(metadata, uri, file_stat)
+    except FileNotFoundError:
+        return False
+
+def _should_retry(retry_policy, failure):
+    # Fail thumbnails without the attempt metadata (such as ones from older versions) count as one attempt made long ago
+    return retry_policy(int(failure.get('X-Nailclipper::Attempts', 1)), float(failure.get('X-Nailclipper::FailTime', 0)))
+
+def _next_attempt(failure):
+    if failure is None:
+        return 1
+    return int(failure.get('X-Nailclipper::Attempts', 1)) + 1
+
+def _layout_depth(cache_layout):
+    """ The number of sub folders a cache layout puts thumbnails in. """
+    return len(cache_layout('0' * 32 + '.png').parts) - 1
+
+def _cache_file_entry(path):
+    """ Returns (path, uri, size, access time) of a cached thumbnail file, the uri is None if the thumbnail can't be read. """
+    try:
+        file_stat = os.stat(path)
+    except FileNotFoundError:
+        return (path, '', 0, 0)
+    try:
+        uri = read_metadata(path).get('Thumb::URI', '')
+    except (OSError, ValueError):
+        uri = None
+    try:
+        # reading the metadata shouldn't count as a use of the thumbnail
+        os.utime(path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+    except OSError:
+        pass
+    return (path, uri, file_stat.st_size, file_stat.st_atime)
+
+def _is_orphaned(uri):
+    """ Checks if a thumbnail's source file is gone (or the thumbnail is unreadable). Thumbnails of other uris are kept. """
+    if uri is None:
+        return True
+    parsed = urlparse(uri)
+    return parsed.scheme == 'file' and not os.path.exists(unquote(parsed.path))
+
 class ThumbnailManager:
 
+    # How many uris each get_thumbnails worker takes at a time, the images it renders are styled together (see create_thumbnail_images)
+    batch_size = 16
+
     def __init__(self,
             cache_folders = { None: '.' },
             thumbnail_generators = { None: ThumbnailGenerator() },
             cache_dir = CacheDir.AUTO,
             compliance = Compliance.NONE,
             refresh_policy = RefreshPolicy.AUTO,
-            fail_folder = 'fail'):
+            fail_folder = 'fail',
+            index = None,
+            cache_layout = CacheLayout.FLAT,
+            store = None,
+            retry_policy = RetryPolicy.BACKOFF,
+            stale_policy = StalePolicy.REFRESH,
+            file_locks = False):
 
         #TODO: implement 'shared' thumbnails part of the Freedesktop spec
 
@@ -26,11 +151,28 @@ class ThumbnailManager:
         self.compliance = compliance
         self.refresh_policy = refresh_policy
         self.fail_folder = fail_folder
+        self.index = index
+        self.cache_layout = cache_layout
+        self.store = store
+        self.retry_policy = retry_policy
+        self.stale_policy = stale_policy
+        self.file_locks = file_locks
 
         if type(self.cache_dir) == str:
             self.cache_dir = Path(self.cache_dir)
 
         self._tempdir = tempfile.TemporaryDirectory()
+        self._async_manager = None
+        self._fail_cache = FailCache()
+        self._revalidate_executor = None
+        self._revalidating = {}
+        self._revalidating_lock = threading.Lock()
+
+        if self.store is not None and self.refresh_policy not in [RefreshPolicy.NEVER, RefreshPolicy.FREEDESKTOP, RefreshPolicy.AUTO] and interval_days(self.refresh_policy) is None:
+            raise ValueError('Thumbnail stores only support the NEVER, FREEDESKTOP, AUTO and INTERVAL refresh policies')
+
+        if self.file_locks and fcntl is None:
+            warn('File locks are not available on this platform, thumbnails may be created by several processes at once')
 
         if not self.compliance(self):
             raise ComplianceError(f'Options do not meet specified compliance spec "{self.compliance.__name__}"')
@@ -39,43 +181,605 @@ class ThumbnailManager:
             tg.init()
 
     def __del__(self):
+        if self._revalidate_executor is not None:
+            self._revalidate_executor.shutdown(wait=False)
         self._tempdir.cleanup()
 
     def get_thumbnail(self, uri, style=None):
 
-        uri = str(uri)
+        uri = _normalize_uri(uri)
 
-        if len(urlparse(uri).scheme) <= 1:
-            uri = Path(uri).resolve().as_uri()
+        thumbnail = self._cached_thumbnail(uri, style)
 
-        save_path = self._thumbnail_path(uri, style)
-        fail_path = self._thumbnail_fail_path(uri)
+        if thumbnail:
+            return thumbnail
 
-        # Current implementation will always return None if we can't get an up-to-date
-        # thumbnail. Should we instead return a stale thumbnail if it exists?
+        if self.stale_policy == StalePolicy.REVALIDATE:
+            thumbnail = self._stale_thumbnail(uri, style)
+            if thumbnail:
+                self._revalidate(uri, style)
+                return thumbnail
 
-        if save_path.exists() and not self.refresh_policy(save_path, uri):
-            return save_path
+        thumbnail = self._update_thumbnail(uri, style)
+
+        if not thumbnail and self.stale_policy == StalePolicy.FALLBACK:
+            return self._stale_thumbnail(uri, style)
+
+        return thumbnail
+
+    def _update_thumbnail(self, uri, style, cancelled=None):
+        """ Creates the thumbnail (unless rendering the file failed before and a retry isn't due), recording a failure if it can't be created.
+            If a cancelled function is given it is checked before rendering and again before saving, nothing is saved once it returns True.
+            With file_locks only one process at a time creates the thumbnail, the others wait and use the one it created. """
+
+        if not self._locks_files():
+            return self._write_thumbnail(uri, style, cancelled)
 
-        if fail_path.exists():
+        with file_lock(self._thumbnail_path(uri, style)):
+            # Another process may have created the thumbnail while waiting for the lock
+            if self.index is not None:
+                self.index.invalidate(uri)
+            thumbnail = self._cached_thumbnail(uri, style)
+            if thumbnail:
+                return thumbnail
+            return self._write_thumbnail(uri, style, cancelled)
+
+    def _write_thumbnail(self, uri, style, cancelled=None):
+
+        failure = self._failure(uri)
+
+        if failure is not None and not _should_retry(self.retry_policy, failure):
             return None
 
-        thumbnail = self.thumbnail_generators[style].create_thumbnail(uri, save_path)
+        if cancelled is None:
+            thumbnail = self._create_thumbnail(uri, style)
+        else:
+            if cancelled():
+                return None
+            tg = self.thumbnail_generators[style]
+            image, shared_key = tg._render(uri, tg.size)
+            if cancelled():
+                return None
+            thumbnail = None if image is None else self._create_thumbnail(uri, style, image, shared_key)
+
+        return self._record_thumbnail(uri, thumbnail, failure)
+
+    def _record_thumbnail(self, uri, thumbnail, failure):
+        """ Records a failure if the thumbnail couldn't be created, or removes the previous failure if it could. Returns the thumbnail. """
 
         if not thumbnail:
-            ThumbnailGenerator.create_fail_thumbnail(uri, fail_path)
+            self._create_fail_thumbnail(uri, failure)
+        elif failure is not None:
+            self._remove_fail_thumbnail(uri)
+
+        if self.index is not None:
+            self.index.invalidate(uri)
 
         return thumbnail
 
-    def _thumbnail_path(self, uri, style):
+    def _get_thumbnail_batch(self, uris, style):
+        """ Gets the thumbnails of several uris like get_thumbnail does, for get_thumbnails. Returns a list of the thumbnails.
+            The images of the thumbnails that have to be created are styled together, see create_thumbnail_images. """
+
+        if self.stale_policy == StalePolicy.REVALIDATE or self._locks_files():
+            # These need get_thumbnail's handling of stale thumbnails and locks
+            return [self.get_thumbnail(uri, style) for uri in uris]
+
+        tg = self.thumbnail_generators[style]
+        thumbnails = {}
+        rendered = []
+
+        for uri in uris:
+            thumbnails[uri] = self._cached_thumbnail(uri, style)
+            if thumbnails[uri]:
+                continue
+            failure = self._failure(uri)
+            if failure is not None and not _should_retry(self.retry_policy, failure):
+                continue
+            image, shared_key = tg._render(uri, tg.size)
+            if image is None:
+                self._record_thumbnail(uri, None, failure)
+            else:
+                rendered.append((uri, image, shared_key, failure))
+
+        # Images shared by many files are only styled once anyway, see create_thumbnail_data
+        styled = tg.create_thumbnail_images([image if shared_key is None or tg.encoder.format != 'PNG' else None for _, image, shared_key, _ in rendered])
+
+        for (uri, image, shared_key, failure), styled_image in zip(rendered, styled):
+            thumbnails[uri] = self._record_thumbnail(uri, self._create_thumbnail(uri, style, image, shared_key, styled_image), failure)
+
+        if self.stale_policy == StalePolicy.FALLBACK:
+            for uri in uris:
+                if not thumbnails[uri]:
+                    thumbnails[uri] = self._stale_thumbnail(uri, style)
+
+        return [thumbnails[uri] for uri in uris]
+
+    async def get_thumbnail_async(self, uri, style=None):
+        """ Awaitable version of get_thumbnail, see AsyncThumbnailManager. """
+        if self._async_manager is None:
+            from nailclipper.async_thumbnail_manager import AsyncThumbnailManager
+            self._async_manager = AsyncThumbnailManager(self)
+        return await self._async_manager.get_thumbnail(uri, style)
+
+    def get_thumbnail_set(self, uri, styles=None):
+        """ Gets thumbnails of one file for several styles (all of them by default) while rendering the file only once.
+            The file is rendered for the largest style and each smaller style is downscaled from the one before it
+            (styles whose generators use other renderers or render options get a rendering of their own).
+            Returns a dict of style to thumbnail. """
+
+        uri = _normalize_uri(uri)
+
+        if styles is None:
+            styles = list(self.thumbnail_generators.keys())
+
+        thumbnails = {}
+        pending = {}
+
+        for style in styles:
+            thumbnails[style] = self._cached_thumbnail(uri, style)
+            if not thumbnails[style]:
+                # Styles can share a cache folder (like None and Size.NORMAL for Freedesktop), only create those once
+                pending.setdefault(self._thumbnail_path(uri, style), []).append(style)
+
+        if not pending:
+            return thumbnails
+
+        if not self._locks_files():
+            return self._create_thumbnail_set(uri, pending, thumbnails)
+
+        with ExitStack() as locks:
+            # Always locked in the same order, so processes creating sets of the same file can't deadlock
+            for save_path in sorted(pending, key=str):
+                locks.enter_context(file_lock(save_path))
+            if self.index is not None:
+                self.index.invalidate(uri)
+            for save_path, pending_styles in list(pending.items()):
+                thumbnail = self._cached_thumbnail(uri, pending_styles[0])
+                if thumbnail:
+                    for style in pending_styles:
+                        thumbnails[style] = thumbnail
+                    del pending[save_path]
+            if not pending:
+                return thumbnails
+            return self._create_thumbnail_set(uri, pending, thumbnails)
+
+    def _create_thumbnail_set(self, uri, pending, thumbnails):
+        """ Creates the pending thumbnails of get_thumbnail_set, a dict of cache path to the styles that share it. """
+
+        failure = self._failure(uri)
+
+        if failure is not None and not _should_retry(self.retry_policy, failure):
+            return thumbnails
+
+        if self.index is not None:
+            self.index.invalidate(uri)
+
+        pending = sorted(pending.items(), key=lambda x: self.thumbnail_generators[x[1][0]].size[0] * self.thumbnail_generators[x[1][0]].size[1], reverse=True)
+
+        # Styles whose generators render differently (other renderers or options) can't share an image, each group is rendered for its largest style
+        groups = []
+        for save_path, pending_styles in pending:
+            options = self.thumbnail_generators[pending_styles[0]]._render_options()
+            for group in groups:
+                if group[0] == options:
+                    group[1].append((save_path, pending_styles))
+                    break
+            else:
+                groups.append((options, [(save_path, pending_styles)]))
+
+        failed = False
+
+        for _, group in groups:
+            largest = self.thumbnail_generators[group[0][1][0]]
+            image, shared_key = largest._render(uri, largest.size)
+
+            if image is None:
+                failed = True
+                continue
+
+            for save_path, pending_styles in group:
+                image = reduce_to_cover(image, self.thumbnail_generators[pending_styles[0]].size)
+                thumbnail = self._create_thumbnail(uri, pending_styles[0], image, shared_key)
+                for style in pending_styles:
+                    thumbnails[style] = thumbnail
+
+        if failed:
+            self._create_fail_thumbnail(uri, failure)
+        elif failure is not None:
+            self._remove_fail_thumbnail(uri)
+
+        return thumbnails
+
+    def get_thumbnails(self, uris, style=None, workers=None, executor='thread'):
+        """ Gets thumbnails for many files in parallel. Returns a generator of (uri, thumbnail) pairs in the order they finish.
+            The executor can be 'thread' or 'process', workers is the pool size (None uses the executor default).
+            Uris that map to the same thumbnail are only generated once. """
+
+        if executor not in ['thread', 'process']:
+            raise ValueError(f'Unknown executor "{executor}", expected "thread" or "process"')
+
+        if executor == 'process' and self.store is not None:
+            raise ValueError('The process executor can only be used with the file cache, use the thread executor with a thumbnail store')
+
+        jobs = {}
+        for uri in uris:
+            uri = _normalize_uri(uri)
+            jobs.setdefault(self._thumbnail_path(uri, style), []).append(uri)
+
+        return self._iter_thumbnails(jobs, style, workers, executor)
+
+    def _iter_thumbnails(self, jobs, style, workers, executor):
+
+        if executor == 'process':
+            tg = self.thumbnail_generators[style]
+            pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(tg, self.refresh_policy, self.retry_policy, self.file_locks))
+            # Worker processes take one uri at a time
+            submit = lambda batch: pool.submit(_refresh_worker_thumbnail, batch[0][1][0], batch[0][0], self._thumbnail_fail_path(batch[0][1][0]))
+            size = 1
+        else:
+            pool = ThreadPoolExecutor(workers)
+            submit = lambda batch: pool.submit(self._get_thumbnail_batch, [uris[0] for _, uris in batch], style)
+            # Batches small enough that every worker gets one (None workers is the ThreadPoolExecutor default)
+            workers = workers or min(32, (os.cpu_count() or 1) + 4)
+            size = max(1, min(ThumbnailManager.batch_size, len(jobs) // workers))
+
+        jobs = list(jobs.items())
+        batches = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+
+        try:
+            futures = {submit(batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    thumbnails = future.result()
+                    if executor == 'process':
+                        thumbnails = [thumbnails]
+                except Exception as e:
+                    for _, uris in batch:
+                        warn(f'Could not get thumbnail for {uris[0]}: {e}')
+                    thumbnails = [None] * len(batch)
+                for (_, uris), thumbnail in zip(batch, thumbnails):
+                    for uri in uris:
+                        yield uri, thumbnail
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def check_directory(self, path, style=None):
+        """ Checks the thumbnails of every file in a directory in bulk, using one scan of the directory and one of the cache folder.
+            Returns a dict of ThumbnailStatus to a list of uris, the stale and missing ones can be passed straight to get_thumbnails. """
+
+        directory = Path(path).resolve()
+        cached = self._cache_lookup(self._thumbnail_cache_dir() / self.cache_folders[style])
+        failed = self._cache_lookup(self._thumbnail_cache_dir() / self.fail_folder)
+        status = {ThumbnailStatus.FRESH: [], ThumbnailStatus.STALE: [], ThumbnailStatus.FAILED: [], ThumbnailStatus.MISSING: []}
+
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+
+                # get_thumbnail resolves symlinks, so they need to be resolved here too to find the same thumbnail
+                if entry.is_symlink():
+                    uri = Path(entry.path).resolve().as_uri()
+                else:
+                    uri = (directory / entry.name).as_uri()
+
+                if self.store is None:
+                    name = self._uri_hash(uri)
+                    cached_entry = cached(name + self.thumbnail_generators[style].encoder.suffix)
+                    is_cached = cached_entry is not None
+                    is_fresh = is_cached and not self._is_stale(uri, style, Path(cached_entry.path), entry.stat())
+                    is_failed = failed(name + '.png') is not None and self._has_failed(uri, entry.stat())
+                else:
+                    metadata = self.store.lookup(self._store_key(uri, style))
+                    is_cached = metadata is not None
+                    is_fresh = is_cached and not self._is_stale(uri, style, None, entry.stat(), metadata)
+                    is_failed = self._has_failed(uri, entry.stat())
+
+                if is_fresh:
+                    status[ThumbnailStatus.FRESH].append(uri)
+                elif is_failed:
+                    status[ThumbnailStatus.FAILED].append(uri)
+                elif is_cached:
+                    status[ThumbnailStatus.STALE].append(uri)
+                else:
+                    status[ThumbnailStatus.MISSING].append(uri)
+
+        return status
+
+    def migrate_cache_layout(self, from_layout=CacheLayout.FLAT, workers=None):
+        """ Moves the thumbnails of all cache folders (and the fail folder) from another layout to this manager's cache_layout,
+            using a pool of worker threads. Returns the number of thumbnails moved. """
+
+        if self.store is not None:
+            raise ValueError('Cache layouts only apply to the file cache, not to thumbnail stores')
+
+        folders = {self._thumbnail_cache_dir() / x for x in self.cache_folders.values()}
+        folders.add(self._thumbnail_cache_dir() / self.fail_folder)
+        depth = _layout_depth(from_layout)
+
+        moves = []
+        for folder in folders:
+            for path in self._layout_files(folder, depth):
+                # Only move files that are really part of the old layout (the fail folder may be inside another cache folder)
+                if path.relative_to(folder) == from_layout(path.name):
+                    target = folder / self.cache_layout(path.name)
+                    if target != path:
+                        moves.append((path, target))
+
+        def move(paths):
+            path, target = paths
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, target)
+            # Clean up the sub folders the old layout leaves empty
+            parent = path.parent
+            for _ in range(depth):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = parent.parent
+
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(move, moves))
+
+        return len(moves)
+
+    def collect_garbage(self, max_bytes=None, max_entries=None, workers=None):
+        """ Removes cached thumbnails (and fail thumbnails) whose source file no longer exists, then evicts the least recently
+            used thumbnails of each cache folder until it holds at most max_bytes and max_entries. Files are scanned in parallel
+            with a pool of worker threads. Recency is the last access time for thumbnail files and the creation time in a store.
+            Returns a dict with the number of 'orphaned' and 'evicted' thumbnails and the number of 'bytes' reclaimed. """
+
+        report = {'orphaned': 0, 'evicted': 0, 'bytes': 0}
+        folders = set(self.cache_folders.values())
+
+        with ThreadPoolExecutor(workers) as pool:
+            for folder in folders | {self.fail_folder}:
+
+                if self.store is None:
+                    entries = list(pool.map(_cache_file_entry, self._layout_files(self._thumbnail_cache_dir() / folder, _layout_depth(self.cache_layout))))
+                else:
+                    entries = self.store.entries(folder)
+
+                kept = []
+                for entry, orphaned in zip(entries, pool.map(_is_orphaned, (x[1] for x in entries))):
+                    if orphaned:
+                        self._remove_cached(entry[0])
+                        report['orphaned'] += 1
+                        report['bytes'] += entry[2] or 0
+                    else:
+                        kept.append(entry)
+
+                if folder not in folders:
+                    continue
+
+                kept.sort(key=lambda x: x[3])
+                total_bytes = sum(x[2] or 0 for x in kept)
+                total_entries = len(kept)
+
+                for entry in kept:
+                    if (max_bytes is None or total_bytes <= max_bytes) and (max_entries is None or total_entries <= max_entries):
+                        break
+                    self._remove_cached(entry[0])
+                    total_bytes -= entry[2] or 0
+                    total_entries -= 1
+                    report['evicted'] += 1
+                    report['bytes'] += entry[2] or 0
+
+        if self.index is not None:
+            self.index.clear()
+        self._fail_cache.clear()
+
+        return report
+
+    def _revalidate(self, uri, style):
+        """ Creates the thumbnail again on a background thread. Revalidations of a thumbnail that is already being created again are skipped. """
+
+        key = self._thumbnail_path(uri, style) if self.store is None else self._store_key(uri, style)
+
+        with self._revalidating_lock:
+            if key in self._revalidating:
+                return self._revalidating[key]
+            if self._revalidate_executor is None:
+                self._revalidate_executor = ThreadPoolExecutor()
+            future = self._revalidate_executor.submit(self._update_thumbnail, uri, style)
+            self._revalidating[key] = future
+
+        def done(future):
+            with self._revalidating_lock:
+                self._revalidating.pop(key, None)
+            if future.exception() is not None:
+                warn(f'Could not revalidate thumbnail for {uri}: {future.exception()}')
+
+        future.add_done_callback(done)
+        return future
+
+    def _stale_thumbnail(self, uri, style):
+        """ Returns the cached thumbnail even if it is stale, or None if there isn't one. """
+        if self.store is not None:
+            return self.store.get(self._store_key(uri, style))
+        save_path = self._thumbnail_path(uri, style)
+        if save_path.exists():
+            return save_path
+        return None
+
+    def _remove_cached(self, key):
+        if self.store is None:
+            try:
+                os.remove(key)
+            except FileNotFoundError:
+                pass
+        else:
+            self.store.delete(key)
+
+    def _layout_files(self, folder, depth):
+        """ Yields the thumbnail files that are exactly depth sub folders down from folder. """
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if depth == 0 and entry.is_file() and entry.name.endswith(suffixes):
+                        yield Path(entry.path)
+                    elif depth > 0 and entry.is_dir():
+                        yield from self._layout_files(Path(entry.path), depth - 1)
+        except FileNotFoundError:
+            return
+
+    def _cache_lookup(self, folder):
+        """ Returns a function that finds the DirEntry of a cache file by name (or None), scanning each (sub)folder only once. """
+        scans = {}
+        def lookup(name):
+            parent = (folder / self.cache_layout(name)).parent
+            if parent not in scans:
+                scans[parent] = self._scan_cache_folder(parent)
+            return scans[parent].get(name)
+        return lookup
+
+    def _scan_cache_folder(self, folder):
+        """ Returns a dict of file name to DirEntry for a cache folder. """
+        try:
+            with os.scandir(folder) as entries:
+                return {entry.name: entry for entry in entries}
+        except FileNotFoundError:
+            return {}
+
+    def _thumbnail_metadata(self, uri, style, save_path):
+        """ Reads the metadata of a cached thumbnail, from the index if possible. """
+        if self.index is None:
+            return read_metadata(save_path)
+        entry = self.index.entry(uri)
+        metadata = entry.thumbnails.get(style)
+        if metadata is None:
+            metadata = read_metadata(save_path)
+            entry.thumbnails[style] = metadata
+        return metadata
+
+    def _cached_thumbnail(self, uri, style):
+        """ Returns the thumbnail if an up-to-date thumbnail is already cached, otherwise None. """
+
+        if self.store is not None:
+            key = self._store_key(uri, style)
+            metadata = self.store.lookup(key)
+            if metadata is not None and not self._is_stale(uri, style, None, metadata=metadata):
+                return self.store.get(key)
+            return None
+
+        save_path = self._thumbnail_path(uri, style)
+
+        if self.index is None:
+            if save_path.exists() and not self.refresh_policy(save_path, uri):
+                return save_path
+            return None
+
+        if style not in self.index.entry(uri).thumbnails and not save_path.exists():
+            return None
+
+        if not self._is_stale(uri, style, save_path):
+            return save_path
+        return None
+
+    def _is_stale(self, uri, style, save_path, file_stat=None, metadata=None):
+        """ Applies the refresh policy, using indexed or stored metadata (and an already known file stat) where the policy allows it. """
+        if self.refresh_policy == RefreshPolicy.NEVER:
+            return False
+        elif urlparse(uri).scheme == 'file' and self.refresh_policy in [RefreshPolicy.FREEDESKTOP, RefreshPolicy.AUTO]:
+            if metadata is None:
+                metadata = self._thumbnail_metadata(uri, style, save_path)
+            return is_stale_metadata(metadata, uri, file_stat)
+        elif self.store is not None:
+            if self.refresh_policy == RefreshPolicy.FREEDESKTOP:
+                # Like RefreshPolicy.FREEDESKTOP, only local files are ever refreshed
+                return False
+            days = 30 if self.refresh_policy == RefreshPolicy.AUTO else interval_days(self.refresh_policy)
+            return (time.time() - metadata['created']) >= (days*24*60*60)
+        else:
+            return self.refresh_policy(save_path, uri)
+
+    def _has_failed(self, uri, file_stat=None):
+        """ Checks if rendering the file failed and it shouldn't be retried yet, see retry_policy. """
+        failure = self._failure(uri, file_stat)
+        return failure is not None and not _should_retry(self.retry_policy, failure)
+
+    def _failure(self, uri, file_stat=None):
+        """ Returns the fail thumbnail metadata of the uri if rendering it failed before, otherwise None.
+            Known failures are kept in memory, so checking them again only takes a stat of the file instead of reading the fail thumbnail. """
+
+        failure = self._fail_cache.get(uri)
+        if failure is not None:
+            if not _is_outdated_failure(failure, uri, file_stat):
+                return failure
+            # The file changed since it failed, so it's worth trying again right away
+            self._remove_fail_thumbnail(uri)
+            return None
+
+        if self.store is None:
+            failure = _read_failure(self._thumbnail_fail_path(uri), uri, file_stat)
+        else:
+            failure = self.store.lookup(self._store_fail_key(uri))
+            if failure is not None and _is_outdated_failure(failure, uri, file_stat):
+                self.store.delete(self._store_fail_key(uri))
+                failure = None
+
+        if failure is not None:
+            self._fail_cache.put(uri, failure)
+        return failure
+
+    def _create_thumbnail(self, uri, style, image=None, shared_key=None, styled=None):
+        """ Creates the thumbnail in the cache (as a file or in the store) and returns it, or None if it can't be created. """
+
+        tg = self.thumbnail_generators[style]
+
+        if self.store is None:
+            return tg.create_thumbnail(uri, self._thumbnail_path(uri, style), image, shared_key, styled)
+
+        data = tg.create_thumbnail_data(uri, image, shared_key, styled)
+
+        if data is None:
+            return None
+
+        data = memoryview(data)
+        self.store.put(self._store_key(uri, style), data, ThumbnailGenerator._thumbnail_metadata(uri))
+        return data
+
+    def _create_fail_thumbnail(self, uri, failure=None):
+        """ Records that the uri couldn't be rendered, counting the attempts made since the previous failure. """
+        if self.store is None:
+            failure = ThumbnailGenerator.create_fail_thumbnail(uri, self._thumbnail_fail_path(uri), _next_attempt(failure))
+        else:
+            failure = ThumbnailGenerator._fail_metadata(uri, _next_attempt(failure))
+            self.store.put(self._store_fail_key(uri), None, failure)
+        self._fail_cache.put(uri, failure)
+
+    def _remove_fail_thumbnail(self, uri):
+        self._fail_cache.invalidate(uri)
+        if self.store is None:
+            self._remove_cached(self._thumbnail_fail_path(uri))
+        else:
+            self._remove_cached(self._store_fail_key(uri))
+
+    def _locks_files(self):
+        # Stores handle concurrent writers themselves, the locks only apply to the file cache
+        return self.file_locks and self.store is None
+
+    def _uri_hash(self, uri):
+        if self.index is not None:
+            return self.index.entry(uri).hash
         md5 = hashlib.md5()
         md5.update(uri.encode('ascii'))
-        return self._thumbnail_cache_dir() / self.cache_folders[style] / f'{md5.hexdigest()}.png'
+        return md5.hexdigest()
+
+    def _thumbnail_path(self, uri, style):
+        return self._thumbnail_cache_dir() / self.cache_folders[style] / self.cache_layout(self._uri_hash(uri) + self.thumbnail_generators[style].encoder.suffix)
 
     def _thumbnail_fail_path(self, uri):
-        md5 = hashlib.md5()
-        md5.update(uri.encode('ascii'))
-        return self._thumbnail_cache_dir() / self.fail_folder / f'{md5.hexdigest()}.png'
+        return self._thumbnail_cache_dir() / self.fail_folder / self.cache_layout(f'{self._uri_hash(uri)}.png')
+
+    def _store_key(self, uri, style):
+        return f'{self.cache_folders[style]}/{self._uri_hash(uri)}'
+
+    def _store_fail_key(self, uri):
+        return f'{self.fail_folder}/{self._uri_hash(uri)}'
 
     def _thumbnail_cache_dir(self):
         if self.cache_dir == CacheDir.AUTO:
@@ -96,7 +800,7 @@ class ThumbnailManager:
         if mask:
             resize_style = ResizeStyle.FILL
         return ThumbnailManager(
-            thumbnail_generators = { None: ThumbnailGenerator(size=size, mask=mask, background=background, foreground=foreground, resize_style=resize_style, renderers=[PillowRenderer]) },
+            thumbnail_generators = { None: ThumbnailGenerator(size=size, mask=mask, background=background, foreground=foreground, resize_style=resize_style, renderers=[ExifRenderer, PillowRenderer]) },
             cache_dir = cache_dir
         )
 
@@ -127,7 +831,7 @@ class ThumbnailManager:
         if mask:
             resize_style = ResizeStyle.FILL
         return ThumbnailManager(
-            thumbnail_generators = { None: ThumbnailGenerator(size=size, mask=mask, background=background, foreground=foreground, resize_style=resize_style, renderers=[PillowRenderer, IconSet]) },
+            thumbnail_generators = { None: ThumbnailGenerator(size=size, mask=mask, background=background, foreground=foreground, resize_style=resize_style, renderers=[ExifRenderer, PillowRenderer, IconSet]) },
             cache_dir = cache_dir
         )
 
@@ -151,5 +855,6 @@ class ThumbnailManager:
             cache_dir = CacheDir.FREEDESKTOP,
             compliance = Compliance.FREEDESKTOP,
             refresh_policy = RefreshPolicy.FREEDESKTOP,
+            retry_policy = RetryPolicy.NEVER,
             fail_folder = f'fail/{application_name}-{application_version}'
         )
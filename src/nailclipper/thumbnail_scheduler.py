@@ -0,0 +1,148 @@
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future, InvalidStateError
+
+from nailclipper.thumbnail_manager import _normalize_uri
+
+class ThumbnailRequest(Future):
+    """ Handle for a thumbnail requested from a ThumbnailScheduler. This is a Future of the thumbnail (or None if it can't be created),
+        cancelling it drops the request even if the thumbnail is already being rendered. """
+
+    def __init__(self, uri, style, priority):
+        super().__init__()
+        self.uri = uri
+        self.style = style
+        self.priority = priority
+        self._entry = None
+
+class ThumbnailScheduler:
+    """ Gets thumbnails on a pool of worker threads in order of priority, for interactive use such as a file browser where
+        only the visible files matter and the view keeps moving. Higher priorities are created first.
+
+        At most max_queued requests wait in the queue, when it's full the request with the lowest priority is cancelled.
+        Cancelled requests never reach the renderers, and ones that are already rendering are dropped before the thumbnail is saved. """
+
+    def __init__(self, thumbnail_manager, workers=4, max_queued=1000):
+
+        self.thumbnail_manager = thumbnail_manager
+        self.max_queued = max_queued
+
+        self._queue = []
+        # The same entries ordered lowest priority first (and newest first within a priority), for dropping requests from a full queue
+        self._lowest = []
+        self._queued = set()
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._shutdown = False
+
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def request(self, uri, style=None, priority=0):
+        """ Queues a thumbnail request and returns its handle. """
+
+        handle = ThumbnailRequest(_normalize_uri(uri), style, priority)
+
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError('Cannot request thumbnails after the scheduler is shut down')
+            self._queued.add(handle)
+            self._push(handle)
+            if len(self._queued) > self.max_queued:
+                self._pop_lowest().cancel()
+            self._condition.notify()
+
+        # Also leaves the queue when the handle itself is cancelled, so it doesn't count against max_queued
+        handle.add_done_callback(self._discard)
+
+        return handle
+
+    def reprioritize(self, handle, priority):
+        """ Changes the priority of a queued request. Returns False if it isn't queued anymore. """
+        with self._condition:
+            if handle not in self._queued:
+                return False
+            handle.priority = priority
+            self._push(handle)
+            return True
+
+    def cancel(self, handle):
+        """ Cancels a request, returns False if its thumbnail was already done. """
+        return handle.cancel()
+
+    def shutdown(self, wait=True, cancel_pending=True):
+        """ Stops the workers once the queue is empty, cancelling all queued requests first if cancel_pending is set. """
+        with self._condition:
+            self._shutdown = True
+            if cancel_pending:
+                for handle in self._queued:
+                    handle.cancel()
+                self._queued.clear()
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _push(self, handle):
+        # Entries are never removed from the heaps, reprioritizing pushes a new entry and the old one is skipped when it comes up
+        handle._entry = (-handle.priority, next(self._counter))
+        heapq.heappush(self._queue, (handle._entry, handle))
+        heapq.heappush(self._lowest, ((handle.priority, -handle._entry[1]), handle))
+
+        if len(self._queue) > 2 * len(self._queued) + 64:
+            self._queue = [x for x in self._queue if x[1] in self._queued and x[0] == x[1]._entry]
+            heapq.heapify(self._queue)
+        if len(self._lowest) > 2 * len(self._queued) + 64:
+            self._lowest = [x for x in self._lowest if x[1] in self._queued and x[0] == (x[1].priority, -x[1]._entry[1])]
+            heapq.heapify(self._lowest)
+
+    def _pop_lowest(self):
+        """ Takes the queued request with the lowest priority (the newest of those) out of the queue. """
+        while True:
+            key, handle = heapq.heappop(self._lowest)
+            if handle in self._queued and key == (handle.priority, -handle._entry[1]):
+                self._queued.discard(handle)
+                return handle
+
+    def _discard(self, handle):
+        with self._condition:
+            self._queued.discard(handle)
+
+    def _next(self):
+        """ Waits for the queued request with the highest priority, or returns None when shut down with an empty queue. """
+        with self._condition:
+            while True:
+                while self._queue:
+                    entry, handle = heapq.heappop(self._queue)
+                    if entry == handle._entry and handle in self._queued:
+                        self._queued.discard(handle)
+                        return handle
+                if self._shutdown:
+                    return None
+                self._condition.wait()
+
+    def _work(self):
+        tm = self.thumbnail_manager
+        while True:
+            handle = self._next()
+            if handle is None:
+                return
+            if handle.cancelled():
+                continue
+            try:
+                thumbnail = tm._cached_thumbnail(handle.uri, handle.style)
+                if not thumbnail:
+                    thumbnail = tm._update_thumbnail(handle.uri, handle.style, handle.cancelled)
+            except Exception as e:
+                self._finish(handle.set_exception, e)
+            else:
+                self._finish(handle.set_result, thumbnail)
+
+    def _finish(self, set_outcome, outcome):
+        try:
+            set_outcome(outcome)
+        except InvalidStateError:
+            # Cancelled while it was being created
+            pass
@@ -0,0 +1,209 @@
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from warnings import warn
+
+class SQLiteStore:
+    """ Stores thumbnails and their metadata in a single SQLite database file instead of one PNG file per thumbnail.
+        The database is in WAL mode so readers don't block each other or the writer, and can be shared between threads and processes.
+
+        Thumbnails are stored under a key (the cache folder and hash of the uri), along with the Thumb::* metadata
+        and the time they were created. Thumbnail data is returned as a memoryview of the PNG bytes. """
+
+    metadata_columns = {
+        'Thumb::URI': 'uri',
+        'Thumb::MTime': 'mtime',
+        'Thumb::Size': 'size',
+        'Thumb::Mimetype': 'mimetype',
+        'X-Nailclipper::Attempts': 'attempts',
+        'X-Nailclipper::FailTime': 'failtime'
+    }
+
+    def __init__(self, path, mmap_size=256*1024*1024):
+        self.path = Path(path)
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._connection()
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, so each thread gets its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS thumbnails (
+                    key TEXT PRIMARY KEY,
+                    uri TEXT,
+                    mtime TEXT,
+                    size TEXT,
+                    mimetype TEXT,
+                    attempts TEXT,
+                    failtime TEXT,
+                    created REAL,
+                    data BLOB
+                )''')
+            self._local.connection = connection
+        return connection
+
+    def lookup(self, key):
+        """ Returns the metadata stored for the key (with the creation time under 'created'), or None if there is no such thumbnail. """
+        columns = ', '.join(self.metadata_columns.values())
+        row = self._connection().execute(f'SELECT {columns}, created FROM thumbnails WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        metadata = {k: v for k, v in zip(self.metadata_columns.keys(), row) if v is not None}
+        metadata['created'] = row[-1]
+        return metadata
+
+    def get(self, key):
+        """ Returns the thumbnail data for the key as a memoryview, or None if there is no such thumbnail. """
+        row = self._connection().execute('SELECT data FROM thumbnails WHERE key = ?', (key,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return memoryview(row[0])
+
+    def put(self, key, data, metadata):
+        """ Stores (or replaces) the thumbnail data and metadata for the key. """
+        columns = ', '.join(self.metadata_columns.values())
+        placeholders = ', '.join('?' * len(self.metadata_columns))
+        self._connection().execute(
+            f'INSERT OR REPLACE INTO thumbnails (key, {columns}, created, data) VALUES (?, {placeholders}, ?, ?)',
+            (key, *(metadata.get(x) for x in self.metadata_columns.keys()), time.time(), data)
+        )
+
+    def entries(self, folder):
+        """ Returns (key, uri, data size, created time) for every thumbnail in a cache folder. """
+        prefix = f'{folder}/'
+        return self._connection().execute(
+            'SELECT key, uri, length(data), created FROM thumbnails WHERE substr(key, 1, ?) = ?', (len(prefix), prefix)
+        ).fetchall()
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM thumbnails WHERE key = ?', (key,))
+
+class MemoryStore:
+    """ Stores thumbnails in memory, for callers that only want the thumbnail data (to send over the network, say) without it touching the disk.
+        Thumbnail data is returned as a memoryview of the stored PNG bytes, without copying them.
+
+        The least recently used thumbnails are dropped once the stored data and metadata take up more than max_bytes.
+        If a backing store (such as an SQLiteStore) is given, thumbnails are also written to it on a background thread (write-behind)
+        and ones that aren't in memory are read from it, so they outlive the process. flush waits for the pending writes. """
+
+    def __init__(self, max_bytes=64*1024*1024, backing=None):
+        self.max_bytes = max_bytes
+        self.backing = backing
+        self.size = 0
+        self._entries = OrderedDict() # key -> (data, metadata, size in bytes)
+        self._lock = threading.Lock()
+        self._pending = {} # key -> (data, metadata) written to memory but not to the backing store yet, None for deletes
+        self._writes = queue.Queue()
+        self._writer = None
+
+    def lookup(self, key):
+        """ Returns the metadata stored for the key (with the creation time under 'created'), or None if there is no such thumbnail. """
+        entry = self._entry(key)
+        return None if entry is None else entry[1]
+
+    def get(self, key):
+        """ Returns the thumbnail data for the key as a memoryview, or None if there is no such thumbnail. """
+        entry = self._entry(key)
+        if entry is None or entry[0] is None:
+            return None
+        return memoryview(entry[0])
+
+    def put(self, key, data, metadata):
+        """ Stores (or replaces) the thumbnail data and metadata for the key. """
+        metadata = dict(metadata, created=time.time())
+        self._remember(key, data, metadata)
+        if self.backing is not None:
+            self._write(key, (data, metadata))
+
+    def entries(self, folder):
+        """ Returns (key, uri, data size, created time) for every thumbnail in a cache folder. """
+        if self.backing is not None:
+            # The backing store has every thumbnail once the pending writes are done
+            self.flush()
+            return self.backing.entries(folder)
+        prefix = f'{folder}/'
+        with self._lock:
+            return [(key, metadata.get('Thumb::URI'), 0 if data is None else len(data), metadata['created'])
+                    for key, (data, metadata, _) in self._entries.items() if key.startswith(prefix)]
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[2]
+        if self.backing is not None:
+            self._write(key, None)
+
+    def flush(self):
+        """ Waits until all thumbnails are written to the backing store. """
+        self._writes.join()
+
+    def _entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+            pending = self._pending.get(key, False)
+        if self.backing is None or pending is None:
+            return None
+        if pending:
+            # Dropped from memory before it was written
+            data, metadata = pending
+        else:
+            metadata = self.backing.lookup(key)
+            if metadata is None:
+                return None
+            data = self.backing.get(key)
+        return self._remember(key, data, metadata)
+
+    def _remember(self, key, data, metadata):
+        size = (0 if data is None else len(data)) + len(key) + sum(len(k) + len(str(v)) for k, v in metadata.items())
+        entry = (data, metadata, size)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[2]
+            if size <= self.max_bytes:
+                self._entries[key] = entry
+                self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self._entries.popitem(last=False)[1][2]
+        return entry
+
+    def _write(self, key, value):
+        with self._lock:
+            self._pending[key] = value
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_behind, daemon=True)
+                self._writer.start()
+        self._writes.put(key)
+
+    def _write_behind(self):
+        while True:
+            key = self._writes.get()
+            try:
+                with self._lock:
+                    value = self._pending.get(key, False)
+                if value is None:
+                    self.backing.delete(key)
+                elif value:
+                    self.backing.put(key, *value)
+                with self._lock:
+                    # Unless it was replaced while being written
+                    if value is not False and self._pending.get(key, False) is value:
+                        del self._pending[key]
+            except Exception as e:
+                warn(f'Could not write thumbnail {key} to {type(self.backing).__name__}: {e}')
+            finally:
+                self._writes.task_done()